@@ -15,13 +15,24 @@ Pipeline:
 from __future__ import annotations
 
 import argparse
-import subprocess
+import os
 import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import List, Dict
-
-# We import overlay_world_state as a library to generate per-clip videos.
+from typing import Any, Callable, List, Dict, Optional, Tuple
+
+# Every stage runs in-process so intermediates stay in memory between stages.
+from src import extract_frames
+from src import run_vlm_inference
+from src import temporal_smoothing
+from src import segment_world_state
+from src import generate_segment_gloss
+from src import build_state_and_planner
 from src import overlay_world_state as ow
+from src import run_yolo
+from src import vlm_infer
+from src.stage_cache import StageCache, hash_path, stage_key
 
 
 PROJECT_ROOT = Path(__file__).resolve().parent
@@ -29,6 +40,9 @@ DATA_DIR = PROJECT_ROOT / "data"
 FRAMES_DIR = DATA_DIR / "frames"
 PRED_DIR = DATA_DIR / "predictions"
 RESULTS_DIR = PROJECT_ROOT / "results"
+CACHE_DIR = DATA_DIR / "cache"
+
+STAGE_CACHE = StageCache(CACHE_DIR)
 
 # Default FPS per clip for nice playback
 DEFAULT_FPS: Dict[str, int] = {
@@ -42,32 +56,120 @@ def log(msg: str) -> None:
     print(msg, flush=True)
 
 
-def run_cmd(label: str, cmd: List[str], skip: bool = False, force: bool = False) -> bool:
+def run_stage(
+    label: str,
+    fn: Callable[..., Any],
+    *args: Any,
+    skip: bool = False,
+    force: bool = False,
+    **kwargs: Any,
+) -> Tuple[bool, Any]:
     """
-    Run a subprocess command with nice logging.
-    Returns True on success, False on failure.
+    Run a pipeline stage in-process with nice logging.
+    Returns (ok, result); result is None when the stage was skipped or failed.
     """
     if skip and not force:
         log(f"[↺] {label}: cached, skipping")
-        return True
+        return True, None
 
     log(f"[▶] {label}...")
     try:
-        subprocess.run(cmd, check=True)
-        log(f"[✓] {label}")
-        return True
-    except subprocess.CalledProcessError as e:
-        log(f"[✖] {label} FAILED with exit code {e.returncode}")
+        result = fn(*args, **kwargs)
+    except Exception as e:
+        log(traceback.format_exc().rstrip())
+        log(f"[✖] {label} FAILED: {e}")
+        return False, None
+    log(f"[✓] {label}")
+    return True, result
+
+
+def cache_hit(
+    stage_id: str,
+    key: str,
+    outputs: List[Path],
+    force: bool = False,
+    adopt: bool = False,
+) -> bool:
+    """
+    True if the stage can be skipped: its outputs for this exact key are cached.
+    With adopt=True, a primary output (outputs[0]) written before the stage had
+    any cache entry is adopted once instead of re-run; missing secondary outputs
+    (e.g. the raw-answer sidecar, which older runs did not write) are created
+    empty. Only the paid VLM stage does this; other stages are cheap to rebuild
+    and existing files may be stale.
+    """
+    if force:
         return False
+    if STAGE_CACHE.lookup(stage_id, key, outputs):
+        return True
+    if adopt and not STAGE_CACHE.has_stage(stage_id) and outputs[0].exists():
+        for p in outputs[1:]:
+            if not p.exists():
+                p.touch()
+        STAGE_CACHE.put(stage_id, key, outputs)
+        return True
+    return False
+
+
+def run_cached_stage(
+    label: str,
+    fn: Callable[..., Any],
+    *args: Any,
+    inputs: List[Path],
+    outputs: List[Path],
+    modules: List[Any],
+    config: Optional[Dict[str, Any]] = None,
+    known: Optional[Dict[Path, str]] = None,
+    force: bool = False,
+    adopt: bool = False,
+    **kwargs: Any,
+) -> Tuple[bool, Any]:
+    """
+    run_stage, skipped when inputs + code + config hash to a cached entry.
+    known holds precomputed input digests. Fresh outputs are stored in the
+    cache on success.
+    """
+    key = stage_key(label, inputs, modules, config, known)
+    skip = cache_hit(label, key, outputs, force=force, adopt=adopt)
+    ok, result = run_stage(label, fn, *args, skip=skip, force=force, **kwargs)
+    if ok and not skip:
+        STAGE_CACHE.put(label, key, outputs)
+    return ok, result
+
+
+def index_or_load(
+    rows: Optional[List[Dict[str, Any]]],
+    index_fn: Callable[[List[Dict[str, Any]]], Any],
+    load_fn: Callable[[Path], Any],
+    path: Path,
+) -> Any:
+    """Index in-memory stage output if we have it, else load it from its CSV."""
+    if rows is not None:
+        return index_fn(rows)
+    return load_fn(path)
+
+
+def hash_frame_dirs(clips: List[str]) -> Dict[Path, str]:
+    """
+    Digest every clip's frame directory once. Frames are the largest stage
+    inputs and several stage keys depend on them, so the keys reuse these.
+    """
+    names = set(clips) | set(run_vlm_inference.CLIPS)
+    if FRAMES_DIR.is_dir():
+        names.update(d.name for d in FRAMES_DIR.iterdir() if d.is_dir())
+    return {FRAMES_DIR / name: hash_path(FRAMES_DIR / name) for name in sorted(names)}
 
 
 def frames_exist_for_clip(clip: str) -> bool:
     d = FRAMES_DIR / clip
-    if not d.exists():
+    if not d.is_dir():
         return False
-    jpgs = list(d.glob("frame_*.jpg"))
-    pngs = list(d.glob("frame_*.png"))
-    return len(jpgs) > 0 or len(pngs) > 0
+    # Only presence matters: stop at the first frame instead of listing all.
+    with os.scandir(d) as it:
+        return any(
+            e.name.startswith("frame_") and e.name.endswith((".jpg", ".png"))
+            for e in it
+        )
 
 
 def ensure_frames(clips: List[str], force: bool = False) -> bool:
@@ -82,8 +184,15 @@ def ensure_frames(clips: List[str], force: bool = False) -> bool:
                 need_extract = True
                 break
 
-    cmd = [sys.executable, "-m", "src.extract_frames"]
-    return run_cmd("extract_frames", cmd, skip=not need_extract, force=force)
+    ok, _ = run_stage(
+        "extract_frames",
+        extract_frames.run,
+        DATA_DIR / "raw_videos",
+        FRAMES_DIR,
+        skip=not need_extract,
+        force=force,
+    )
+    return ok
 
 
 def main():
@@ -143,19 +252,25 @@ def main():
         log("Aborting: frame extraction failed.")
         sys.exit(1)
 
+    frame_digests = hash_frame_dirs(clips)
+
     # -------------------------------------------------------
     # [1] VLM inference (global CSV)
     # -------------------------------------------------------
     world_state_csv = PRED_DIR / "world_state_claude.csv"
-    vlm_skip = world_state_csv.exists() and not force
-    if vlm_skip:
-        log(f"[↺] world_state_claude.csv already exists at {world_state_csv}")
-    if not run_cmd(
+    ok, raw_rows = run_cached_stage(
         "run_vlm_inference",
-        [sys.executable, "-m", "src.run_vlm_inference"],
-        skip=vlm_skip,
+        run_vlm_inference.run,
+        FRAMES_DIR,
+        world_state_csv,
+        inputs=[FRAMES_DIR / c for c in run_vlm_inference.CLIPS],
+        outputs=[world_state_csv, run_vlm_inference.raw_sidecar_path(world_state_csv)],
+        modules=[run_vlm_inference, vlm_infer],
+        known=frame_digests,
         force=force,
-    ):
+        adopt=True,
+    )
+    if not ok:
         log("Aborting: VLM inference failed.")
         sys.exit(1)
 
@@ -163,15 +278,18 @@ def main():
     # [2] Temporal smoothing
     # -------------------------------------------------------
     smoothed_csv = PRED_DIR / "world_state_claude_smoothed.csv"
-    smoothing_skip = smoothed_csv.exists() and not force
-    if smoothing_skip:
-        log(f"[↺] world_state_claude_smoothed.csv already exists at {smoothed_csv}")
-    if not run_cmd(
+    ok, smoothed_rows = run_cached_stage(
         "temporal_smoothing",
-        [sys.executable, "-m", "src.temporal_smoothing"],
-        skip=smoothing_skip,
+        temporal_smoothing.run,
+        world_state_csv,
+        smoothed_csv,
+        rows=raw_rows,
+        inputs=[world_state_csv],
+        outputs=[smoothed_csv],
+        modules=[temporal_smoothing],
         force=force,
-    ):
+    )
+    if not ok:
         log("Aborting: temporal smoothing failed.")
         sys.exit(1)
 
@@ -179,15 +297,18 @@ def main():
     # [3] Segment world state
     # -------------------------------------------------------
     segments_csv = PRED_DIR / "world_state_segments.csv"
-    segment_skip = segments_csv.exists() and not force
-    if segment_skip:
-        log(f"[↺] world_state_segments.csv already exists at {segments_csv}")
-    if not run_cmd(
+    ok, segment_rows = run_cached_stage(
         "segment_world_state",
-        [sys.executable, "-m", "src.segment_world_state"],
-        skip=segment_skip,
+        segment_world_state.run,
+        smoothed_csv,
+        segments_csv,
+        rows=smoothed_rows,
+        inputs=[smoothed_csv],
+        outputs=[segments_csv],
+        modules=[segment_world_state, temporal_smoothing],
         force=force,
-    ):
+    )
+    if not ok:
         log("Aborting: segmentation failed.")
         sys.exit(1)
 
@@ -195,15 +316,21 @@ def main():
     # [4] Generate segment gloss
     # -------------------------------------------------------
     gloss_csv = PRED_DIR / "segment_gloss.csv"
-    gloss_skip = gloss_csv.exists() and not force
-    if gloss_skip:
-        log(f"[↺] segment_gloss.csv already exists at {gloss_csv}")
-    if not run_cmd(
+    ok, gloss_rows = run_cached_stage(
         "generate_segment_gloss",
-        [sys.executable, "-m", "src.generate_segment_gloss"],
-        skip=gloss_skip,
+        generate_segment_gloss.run,
+        segments_csv,
+        FRAMES_DIR,
+        gloss_csv,
+        segments=segment_rows,
+        inputs=[segments_csv, *frame_digests],
+        outputs=[gloss_csv],
+        modules=[generate_segment_gloss],
+        config={"model": generate_segment_gloss.MODEL_NAME},
+        known=frame_digests,
         force=force,
-    ):
+    )
+    if not ok:
         log("Aborting: gloss generation failed.")
         sys.exit(1)
 
@@ -211,15 +338,24 @@ def main():
     # [5] Build state machine + planner commands
     # -------------------------------------------------------
     planner_csv = PRED_DIR / "planner_commands.csv"
-    planner_skip = planner_csv.exists() and not force
-    if planner_skip:
-        log(f"[↺] planner_commands.csv already exists at {planner_csv}")
-    if not run_cmd(
+    ok, planner_out = run_cached_stage(
         "build_state_and_planner",
-        [sys.executable, "-m", "src.build_state_and_planner"],
-        skip=planner_skip,
+        build_state_and_planner.run,
+        world_state_csv,
+        smoothed_csv,
+        PRED_DIR,
+        raw_rows=raw_rows,
+        smoothed_rows=smoothed_rows,
+        inputs=[world_state_csv, smoothed_csv],
+        outputs=[
+            planner_csv,
+            PRED_DIR / "world_state_machine.csv",
+            PRED_DIR / "world_state_final.csv",
+        ],
+        modules=[build_state_and_planner],
         force=force,
-    ):
+    )
+    if not ok:
         log("Aborting: planner build failed.")
         sys.exit(1)
 
@@ -228,38 +364,75 @@ def main():
     # -------------------------------------------------------
     RESULTS_DIR.mkdir(parents=True, exist_ok=True)
 
-    # Load predictions / segments / gloss / planner once
-    preds = ow.load_smoothed_preds(smoothed_csv)
-    segments = ow.load_segments(segments_csv)
-    glosses = ow.load_gloss(gloss_csv)
-    planner = ow.load_planner(planner_csv)
+    # Index predictions / segments / gloss / planner once, reusing what the
+    # stages above kept in memory and only reading CSVs for skipped stages.
+    planner_rows = planner_out.planner_rows if planner_out is not None else None
+    preds = index_or_load(smoothed_rows, ow.index_smoothed_preds, ow.load_smoothed_preds, smoothed_csv)
+    segments = index_or_load(segment_rows, ow.index_segments, ow.load_segments, segments_csv)
+    glosses = index_or_load(gloss_rows, ow.index_gloss, ow.load_gloss, gloss_csv)
+    planner = index_or_load(planner_rows, ow.index_planner, ow.load_planner, planner_csv)
 
     overlay_failures = []
 
+    # Work out which clips actually need rendering before spinning up workers.
+    pending: Dict[str, Tuple[int, str]] = {}
     for clip in clips:
         fps = args.fps if args.fps is not None else DEFAULT_FPS.get(clip, 2)
         out_path = RESULTS_DIR / f"{clip}_overlay.mp4"
 
-        if out_path.exists() and not force:
-            log(f"[↺] overlay for {clip} already exists at {out_path}")
+        stage_id = f"overlay_{clip}"
+        key = stage_key(
+            stage_id,
+            [FRAMES_DIR / clip, smoothed_csv, segments_csv, gloss_csv, planner_csv],
+            [ow, run_yolo, extract_frames],
+            {"fps": fps},
+            frame_digests,
+        )
+        if cache_hit(stage_id, key, [out_path], force=force):
+            log(f"[↺] overlay for {clip} cached at {out_path}")
             continue
-
-        log(f"[▶] overlay_world_state for {clip} (fps={fps})...")
-        try:
-            ow.make_overlay_video_for_clip(
-                clip_name=clip,
-                frames_root=FRAMES_DIR,
-                preds=preds,
-                segments=segments,
-                gloss=glosses,
-                planner=planner,
-                out_dir=RESULTS_DIR,
-                fps=fps,
-            )
-            log(f"[✓] overlay for {clip} → {out_path}")
-        except Exception as e:
-            log(f"[✖] overlay for {clip} FAILED: {e}")
-            overlay_failures.append(clip)
+        pending[clip] = (fps, key)
+
+    # Clips are independent (frame decode + HUD + encode), so render them in
+    # parallel. The index dicts are read-only and pickle cleanly to workers.
+    # Each clip then renders its frames on its share of the cores; torch in a
+    # clip process is capped at that share too (its render workers use 1 each).
+    if pending:
+        max_workers = min(len(pending), os.cpu_count() or 1)
+        render_workers = max(1, (os.cpu_count() or 1) // len(pending))
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=ow.limit_threads,
+            initargs=(render_workers,),
+        ) as ex:
+            futs = {}
+            for clip, (fps, _) in pending.items():
+                log(f"[▶] overlay_world_state for {clip} (fps={fps})...")
+                fut = ex.submit(
+                    ow.make_overlay_video_for_clip,
+                    clip_name=clip,
+                    frames_root=FRAMES_DIR,
+                    preds=preds,
+                    segments=segments,
+                    gloss=glosses,
+                    planner=planner,
+                    out_dir=RESULTS_DIR,
+                    fps=fps,
+                    workers=render_workers,
+                )
+                futs[fut] = clip
+
+            for fut in as_completed(futs):
+                clip = futs[fut]
+                out_path = RESULTS_DIR / f"{clip}_overlay.mp4"
+                try:
+                    fut.result()
+                    STAGE_CACHE.put(f"overlay_{clip}", pending[clip][1], [out_path])
+                    log(f"[✓] overlay for {clip} → {out_path}")
+                except Exception as e:
+                    log(traceback.format_exc().rstrip())
+                    log(f"[✖] overlay for {clip} FAILED: {e}")
+                    overlay_failures.append(clip)
 
     # -------------------------------------------------------
     # Summary
@@ -1,32 +1,105 @@
 # src/build_state_and_planner.py
 
 from __future__ import annotations
-from pathlib import Path
 import csv
-from typing import Dict, Tuple, List, Any, Optional
+from dataclasses import dataclass
+from enum import IntEnum
+from pathlib import Path
+import sys
+from typing import Dict, Tuple, List, Any, Iterable, Iterator, Optional
+
+import numpy as np
+import pandas as pd
 
 
 Key = Tuple[str, int]  # (clip, frame_index)
 
+# World-state label fields. Their values (and every *_smoothed / *_final
+# variant) are stripped and interned once when rows enter this stage
+# (index_raw_world / load_raw_world / normalize_rows); nothing downstream re-strips.
+LABEL_FIELDS = ("affordance", "yield_to", "lead_state")
+
+
+@dataclass
+class PlannerOutputs:
+    """
+    In-memory results of this stage, mirroring the three CSVs it writes.
+    """
+    final_rows: List[Dict[str, Any]]
+    segments: List[Dict[str, Any]]
+    planner_rows: List[Dict[str, Any]]
+
+
+def index_raw_world(rows: Iterable[Dict[str, Any]]) -> Dict[Key, Dict[str, str]]:
+    """
+    Index raw VLM world state rows by (clip, frame_index).
+    """
+    raw: Dict[Key, Dict[str, str]] = {}
+    for row in rows:
+        clip = sys.intern(row["clip"].strip())
+        fi = int(row["frame_index"])
+        key = (clip, fi)
+        raw[key] = {k: sys.intern(row[k].strip()) for k in LABEL_FIELDS}
+    return raw
+
+
+def _intern(values: Iterable[str]) -> List[str]:
+    """Canonical string objects, so repeated labels share storage and hash."""
+    return [sys.intern(v) for v in values]
+
+
+def normalize_rows(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Strip and intern clip and every label field (raw / smoothed) of each row,
+    in place. Smoothed rows go through here whether read from disk or handed
+    over in memory by temporal_smoothing.
+    """
+    if not rows:
+        return rows
+    cols = [c for c in rows[0] if c == "clip" or c.startswith(LABEL_FIELDS)]
+    intern = sys.intern
+    for row in rows:
+        for c in cols:
+            row[c] = intern((row.get(c) or "").strip())
+    return rows
+
+
+def normalize_labels(df: pd.DataFrame) -> pd.DataFrame:
+    """Strip clip and every label column (raw / smoothed / final) in place."""
+    for col in df.columns:
+        if col == "clip" or col.startswith(LABEL_FIELDS):
+            df[col] = df[col].fillna("").astype(str).str.strip()
+    return df
+
+
+def read_table(path: Path, usecols: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Read a pipeline CSV (optionally only usecols) with pandas' multi-threaded
+    pyarrow parser. All columns stay strings (empty cells as ""), except frame_index.
+    """
+    df = pd.read_csv(path, engine="pyarrow", dtype=str, keep_default_na=False, usecols=usecols)
+    if "frame_index" in df.columns:
+        df["frame_index"] = df["frame_index"].astype("int32")
+    return df
+
 
 def load_raw_world(path: Path) -> Dict[Key, Dict[str, str]]:
     """
     Load raw VLM world state (no smoothing).
     Expected columns: clip, frame_index, affordance, yield_to, lead_state, ...
     """
-    raw: Dict[Key, Dict[str, str]] = {}
-    with path.open("r", newline="") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            clip = row["clip"].strip()
-            fi = int(row["frame_index"])
-            key = (clip, fi)
-            raw[key] = {
-                "affordance": row["affordance"].strip(),
-                "yield_to": row["yield_to"].strip(),
-                "lead_state": row["lead_state"].strip(),
-            }
-    return raw
+    df = normalize_labels(read_table(path, usecols=["clip", "frame_index", *LABEL_FIELDS]))
+    cols = zip(
+        _intern(df["clip"].tolist()),
+        df["frame_index"].tolist(),
+        _intern(df["affordance"].tolist()),
+        _intern(df["yield_to"].tolist()),
+        _intern(df["lead_state"].tolist()),
+    )
+    return {
+        (clip, fi): {"affordance": a, "yield_to": y, "lead_state": l}
+        for clip, fi, a, y, l in cols
+    }
 
 
 def load_smoothed_world(path: Path) -> List[Dict[str, Any]]:
@@ -34,14 +107,14 @@ def load_smoothed_world(path: Path) -> List[Dict[str, Any]]:
     Load smoothed world state rows.
     Expected columns include:
       clip, frame_index, affordance_smoothed, yield_to_smoothed, lead_state_smoothed
+    Labels come back normalized (see normalize_rows).
     """
-    rows: List[Dict[str, Any]] = []
-    with path.open("r", newline="") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            row["frame_index"] = int(row["frame_index"])
-            rows.append(row)
-    return rows
+    df = read_table(path)
+    # Column-wise tolist + zip: much cheaper than to_dict("records") on
+    # pyarrow-backed string columns.
+    names = list(df.columns)
+    rows = [dict(zip(names, values)) for values in zip(*(df[c].tolist() for c in names))]
+    return normalize_rows(rows)
 
 
 def reinject_go_short(
@@ -52,39 +125,33 @@ def reinject_go_short(
     For each frame, if raw predicted affordance == 'go' but smoothed did not,
     and we're not yielding to pedestrians, overwrite the smoothed triple
     with the raw triple (SHORT mode: no temporal stretching).
+    Labels are expected to be normalized already (see normalize_rows).
     """
     updated: List[Dict[str, Any]] = []
+    get_raw = raw_map.get
 
     for row in smoothed_rows:
-        clip = row["clip"].strip()
-        fi = int(row["frame_index"])
-        key = (clip, fi)
-
         # Base smoothed triple
-        a_sm = row.get("affordance_smoothed", row.get("affordance", "")).strip()
-        y_sm = row.get("yield_to_smoothed", row.get("yield_to", "")).strip()
-        l_sm = row.get("lead_state_smoothed", row.get("lead_state", "")).strip()
+        a_sm = row.get("affordance_smoothed", row.get("affordance", ""))
+        y_sm = row.get("yield_to_smoothed", row.get("yield_to", ""))
+        l_sm = row.get("lead_state_smoothed", row.get("lead_state", ""))
 
         a_final, y_final, l_final = a_sm, y_sm, l_sm
 
-        raw = raw_map.get(key)
-        if raw is not None:
-            a_raw = raw["affordance"]
-            y_raw = raw["yield_to"]
-            l_raw = raw["lead_state"]
-
-            # Re-inject GO only if:
-            #  - raw saw GO
-            #  - smoothed did NOT keep GO
-            #  - we're not dealing with pedestrians (they dominate)
-            #  - raw is not yielding to ped either
-            if (
-                a_raw == "go"
-                and a_sm != "go"
-                and y_sm != "ped"
-                and y_raw != "ped"
-            ):
-                a_final, y_final, l_final = a_raw, y_raw, l_raw
+        raw = get_raw((row["clip"], int(row["frame_index"])))
+        # Re-inject GO only if:
+        #  - raw saw GO
+        #  - smoothed did NOT keep GO
+        #  - we're not dealing with pedestrians (they dominate)
+        #  - raw is not yielding to ped either
+        if (
+            raw is not None
+            and raw["affordance"] == "go"
+            and a_sm != "go"
+            and y_sm != "ped"
+            and raw["yield_to"] != "ped"
+        ):
+            a_final, y_final, l_final = raw["affordance"], raw["yield_to"], raw["lead_state"]
 
         row["affordance_final"] = a_final
         row["yield_to_final"] = y_final
@@ -98,11 +165,8 @@ def map_world_to_state(a: str, y: str, l: str) -> str:
     """
     Map (affordance, yield_to, lead_state) to a symbolic driving state.
     This is the mid-stack state machine abstraction.
+    Labels are expected to be normalized already (see load_raw_world).
     """
-    a = a.strip()
-    y = y.strip()
-    l = l.strip()
-
     # Pedestrians dominate
     if y == "ped":
         if a == "stop":
@@ -138,261 +202,329 @@ def map_world_to_state(a: str, y: str, l: str) -> str:
     return "UNKNOWN"
 
 
-def segment_states(
-    rows: List[Dict[str, Any]],
-) -> List[Dict[str, Any]]:
+# Label vocabularies as emitted by the VLM parser ("" = invalid/missing).
+AFFORDANCES = ("go", "wait", "stop", "")
+YIELD_TARGETS = ("none", "lead", "ped", "")
+LEAD_STATES = ("none", "moving", "stopped", "")
+
+
+class State(IntEnum):
     """
-    Given per-frame rows (with *_final fields), build segments of constant state.
-    Returns segment list with:
-      clip, segment_id, start_frame, end_frame, state,
-      affordance, yield_to, lead_state
+    Integer codes for the symbolic states returned by map_world_to_state.
+    Names are only materialized when segments are built.
     """
-    by_clip: Dict[str, List[Dict[str, Any]]] = {}
-    for r in rows:
-        by_clip.setdefault(r["clip"], []).append(r)
-
-    segments: List[Dict[str, Any]] = []
-
-    for clip, clip_rows in by_clip.items():
-        clip_rows = sorted(clip_rows, key=lambda r: r["frame_index"])
-
-        current_state: Optional[str] = None
-        current_start: Optional[int] = None
-        current_end: Optional[int] = None
-        current_aff: str = ""
-        current_y: str = ""
-        current_l: str = ""
-
-        seg_id = 0
-
-        for r in clip_rows:
-            fi = int(r["frame_index"])
-            a = r["affordance_final"]
-            y = r["yield_to_final"]
-            l = r["lead_state_final"]
-            s = map_world_to_state(a, y, l)
-
-            if current_state is None:
-                current_state = s
-                current_start = fi
-                current_end = fi
-                current_aff, current_y, current_l = a, y, l
-            else:
-                if s == current_state and fi == current_end + 1:
-                    current_end = fi
-                    # keep first triple as canonical
-                else:
-                    # close previous segment
-                    segments.append(
-                        {
-                            "clip": clip,
-                            "segment_id": seg_id,
-                            "start_frame": current_start,
-                            "end_frame": current_end,
-                            "state": current_state,
-                            "affordance": current_aff,
-                            "yield_to": current_y,
-                            "lead_state": current_l,
-                        }
-                    )
-                    seg_id += 1
-                    # start new
-                    current_state = s
-                    current_start = fi
-                    current_end = fi
-                    current_aff, current_y, current_l = a, y, l
-
-        # close last
-        if current_state is not None:
-            segments.append(
-                {
-                    "clip": clip,
-                    "segment_id": seg_id,
-                    "start_frame": current_start,
-                    "end_frame": current_end,
-                    "state": current_state,
-                    "affordance": current_aff,
-                    "yield_to": current_y,
-                    "lead_state": current_l,
-                }
-            )
-
-    return segments
-
-
-def add_prev_next(segments: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    STOP_PED = 0
+    YIELD_PED = 1
+    STOP_LEAD = 2
+    FOLLOW_QUEUE = 3
+    GO_FOLLOW = 4
+    GO_FREE = 5
+    GO = 6
+    NEGOTIATE = 7
+    UNKNOWN = 8
+
+
+# map_world_to_state evaluated once over the whole (small) label domain.
+STATE_TABLE: Dict[Tuple[str, str, str], State] = {
+    (a, y, l): State[map_world_to_state(a, y, l)]
+    for a in AFFORDANCES
+    for y in YIELD_TARGETS
+    for l in LEAD_STATES
+}
+
+
+# Plain-int view of STATE_TABLE and code -> name, for the per-frame hot loop
+# (IntEnum construction and arithmetic are slow there).
+STATE_CODES: Dict[Tuple[str, str, str], int] = {k: int(v) for k, v in STATE_TABLE.items()}
+STATE_NAMES: Tuple[str, ...] = tuple(s.name for s in sorted(State))
+
+
+def lookup_state(a: str, y: str, l: str) -> State:
     """
-    For each clip, add prev_state and next_state to segments.
+    O(1) state code lookup for already-stripped labels; anything outside the
+    vocabulary falls back to map_world_to_state.
     """
-    by_clip: Dict[str, List[Dict[str, Any]]] = {}
-    for seg in segments:
-        by_clip.setdefault(seg["clip"], []).append(seg)
-
-    out: List[Dict[str, Any]] = []
+    s = STATE_TABLE.get((a, y, l))
+    if s is None:
+        s = State[map_world_to_state(a, y, l)]
+    return s
 
-    for clip, clip_segs in by_clip.items():
-        clip_segs = sorted(clip_segs, key=lambda s: s["segment_id"])
-        n = len(clip_segs)
-        for i, seg in enumerate(clip_segs):
-            prev_state = clip_segs[i - 1]["state"] if i > 0 else ""
-            next_state = clip_segs[i + 1]["state"] if i < n - 1 else ""
-            seg["prev_state"] = prev_state
-            seg["next_state"] = next_state
-            out.append(seg)
 
-    return out
+def _segment_bounds(
+    clip_ids: np.ndarray, fi: np.ndarray, states: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (starts, ends) row positions of runs with the same clip and state over
+    contiguous frames. Rows must be sorted by (clip, frame_index).
+    """
+    boundaries = (
+        (clip_ids[1:] != clip_ids[:-1])
+        | (states[1:] != states[:-1])
+        | (fi[1:] != fi[:-1] + 1)
+    )
+    starts = np.concatenate(([0], np.flatnonzero(boundaries) + 1))
+    ends = np.append(starts[1:], len(fi)) - 1
+    return starts, ends
 
 
-def map_state_to_planner(state: str) -> Dict[str, str]:
+def segment_states(
+    rows: List[Dict[str, Any]],
+) -> Iterator[Dict[str, Any]]:
     """
-    Map a symbolic state to a planner command abstraction.
+    Given per-frame rows (with *_final fields), yield segments of constant state
+    in (clip, frame_index) order, with prev_state / next_state filled in.
     """
-    state = state.strip()
-
-    if state == "FOLLOW_QUEUE":
-        return {
-            "planner_cmd": "FOLLOW",
-            "reason": "traffic_queue",
-            "target": "lead",
-            "until": "lead_moves",
-        }
-    if state == "GO_FOLLOW":
-        return {
-            "planner_cmd": "GO",
-            "reason": "lead_moving",
-            "target": "lead",
-            "until": "constraint_reappears",
-        }
-    if state in ("GO_FREE", "GO"):
-        return {
-            "planner_cmd": "GO",
-            "reason": "corridor_clear",
-            "target": "",
-            "until": "constraint_reappears",
-        }
-    if state == "YIELD_PED":
-        return {
-            "planner_cmd": "WAIT",
-            "reason": "pedestrian_in_path",
-            "target": "ped",
-            "until": "ped_clears",
-        }
-    if state == "STOP_PED":
-        return {
-            "planner_cmd": "STOP",
-            "reason": "pedestrian_blocking",
-            "target": "ped",
-            "until": "ped_clears",
-        }
-    if state == "STOP_LEAD":
-        return {
-            "planner_cmd": "STOP",
-            "reason": "lead_vehicle_stopped",
-            "target": "lead",
-            "until": "lead_moves",
-        }
-    if state == "NEGOTIATE":
-        return {
-            "planner_cmd": "WAIT",
-            "reason": "negotiating_gap",
-            "target": "",
-            "until": "scene_resolves",
+    if not rows:
+        return
+
+    # One pass over the rows: clip rank (order of first appearance), frame
+    # index and state code.
+    clip_rank: Dict[str, int] = {}
+    state_code = STATE_CODES.get
+    clip_list: List[int] = []
+    fi_list: List[int] = []
+    state_list: List[int] = []
+    for r in rows:
+        clip = r["clip"]
+        rank = clip_rank.get(clip)
+        if rank is None:
+            rank = clip_rank[clip] = len(clip_rank)
+        key = (r["affordance_final"], r["yield_to_final"], r["lead_state_final"])
+        code = state_code(key)
+        if code is None:
+            code = int(lookup_state(*key))
+        clip_list.append(rank)
+        fi_list.append(int(r["frame_index"]))
+        state_list.append(code)
+    clip_ids = np.array(clip_list, dtype=np.int32)
+    fi = np.array(fi_list, dtype=np.int32)
+    states = np.array(state_list, dtype=np.int8)
+
+    # Usually already in (clip, frame_index) order; otherwise a stable lexsort.
+    in_order = (clip_ids[1:] > clip_ids[:-1]) | (
+        (clip_ids[1:] == clip_ids[:-1]) & (fi[1:] >= fi[:-1])
+    )
+    if in_order.all():
+        ordered = rows
+    else:
+        order = np.lexsort((fi, clip_ids))
+        clip_ids, fi, states = clip_ids[order], fi[order], states[order]
+        ordered = [rows[i] for i in order.tolist()]
+
+    starts, ends = _segment_bounds(clip_ids, fi, states)
+    # Whether each segment continues the clip of the one before it.
+    seg_clips = clip_ids[starts]
+    same_clip_as_prev = np.concatenate(([False], seg_clips[1:] == seg_clips[:-1]))
+
+    names = [STATE_NAMES[c] for c in states[starts].tolist()]
+    # A segment is yielded once the next one has set its next_state.
+    pending: Optional[Dict[str, Any]] = None
+    seg_id = 0
+    for k, (i, j) in enumerate(zip(starts.tolist(), ends.tolist())):
+        r = ordered[i]
+        if same_clip_as_prev[k]:
+            seg_id += 1
+            prev_state = names[k - 1]
+            pending["next_state"] = names[k]
+        else:
+            seg_id = 0
+            prev_state = ""
+        if pending is not None:
+            yield pending
+
+        pending = {
+            "clip": r["clip"],
+            "segment_id": seg_id,
+            "start_frame": int(fi[i]),
+            "end_frame": int(fi[j]),
+            "state": names[k],
+            "affordance": r["affordance_final"],
+            "yield_to": r["yield_to_final"],
+            "lead_state": r["lead_state_final"],
+            "prev_state": prev_state,
+            "next_state": "",
         }
 
-    # Fallback
-    return {
+    yield pending
+
+
+# Planner command per symbolic state. The inner dicts are shared by every
+# caller, so treat them as read-only (copy before updating).
+PLANNER_TABLE: Dict[str, Dict[str, str]] = {
+    "FOLLOW_QUEUE": {
+        "planner_cmd": "FOLLOW",
+        "reason": "traffic_queue",
+        "target": "lead",
+        "until": "lead_moves",
+    },
+    "GO_FOLLOW": {
+        "planner_cmd": "GO",
+        "reason": "lead_moving",
+        "target": "lead",
+        "until": "constraint_reappears",
+    },
+    "GO_FREE": {
+        "planner_cmd": "GO",
+        "reason": "corridor_clear",
+        "target": "",
+        "until": "constraint_reappears",
+    },
+    "YIELD_PED": {
         "planner_cmd": "WAIT",
-        "reason": "unknown_state",
+        "reason": "pedestrian_in_path",
+        "target": "ped",
+        "until": "ped_clears",
+    },
+    "STOP_PED": {
+        "planner_cmd": "STOP",
+        "reason": "pedestrian_blocking",
+        "target": "ped",
+        "until": "ped_clears",
+    },
+    "STOP_LEAD": {
+        "planner_cmd": "STOP",
+        "reason": "lead_vehicle_stopped",
+        "target": "lead",
+        "until": "lead_moves",
+    },
+    "NEGOTIATE": {
+        "planner_cmd": "WAIT",
+        "reason": "negotiating_gap",
         "target": "",
-        "until": "state_resolved",
-    }
+        "until": "scene_resolves",
+    },
+}
+PLANNER_TABLE["GO"] = PLANNER_TABLE["GO_FREE"]
 
+_FALLBACK: Dict[str, str] = {
+    "planner_cmd": "WAIT",
+    "reason": "unknown_state",
+    "target": "",
+    "until": "state_resolved",
+}
 
-def write_csv(path: Path, fieldnames: List[str], rows: List[Dict[str, Any]]) -> None:
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("w", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        for r in rows:
-            writer.writerow({k: r.get(k, "") for k in fieldnames})
-
-
-def main():
-    project_root = Path(__file__).resolve().parents[1]
-    preds_root = project_root / "data" / "predictions"
-
-    raw_path = preds_root / "world_state_claude.csv"
-    smoothed_path = preds_root / "world_state_claude_smoothed.csv"
 
-    if not raw_path.exists():
-        raise FileNotFoundError(f"Raw world state not found: {raw_path}")
-    if not smoothed_path.exists():
-        raise FileNotFoundError(f"Smoothed world state not found: {smoothed_path}")
+def map_state_to_planner(state: str) -> Dict[str, str]:
+    """
+    Map a symbolic state to a planner command abstraction.
+    Returns a shared dict from PLANNER_TABLE; do not mutate it.
+    """
+    return PLANNER_TABLE.get(state.strip(), _FALLBACK)
 
-    print(f"Loading raw from: {raw_path}")
-    print(f"Loading smoothed from: {smoothed_path}")
 
-    raw_map = load_raw_world(raw_path)
-    smoothed_rows = load_smoothed_world(smoothed_path)
+def write_csv(path: Path, fieldnames: List[str], rows: List[Dict[str, Any]]) -> None:
+    """
+    Write rows (missing fields as "") through pandas.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    df = pd.DataFrame(rows).reindex(columns=fieldnames)
+    for col in fieldnames:
+        if col.startswith(LABEL_FIELDS):
+            vals = df[col].dropna().astype(str)
+            if not (vals == vals.str.strip()).all():
+                raise ValueError(f"{path.name}: {col} labels are not normalized")
+    # \r\n matches what csv.DictWriter has always produced for these files.
+    df.to_csv(path, index=False, lineterminator="\r\n")
+
+
+def run(
+    raw_path: Path,
+    smoothed_path: Path,
+    out_dir: Path,
+    raw_rows: Optional[List[Dict[str, Any]]] = None,
+    smoothed_rows: Optional[List[Dict[str, Any]]] = None,
+) -> PlannerOutputs:
+    """
+    Build final frame states, the symbolic state machine and planner commands.
+    In-memory raw/smoothed rows are used when given, otherwise the CSVs are read.
+    """
+    if raw_rows is not None:
+        raw_map = index_raw_world(raw_rows)
+    else:
+        if not raw_path.exists():
+            raise FileNotFoundError(f"Raw world state not found: {raw_path}")
+        print(f"Loading raw from: {raw_path}")
+        raw_map = load_raw_world(raw_path)
+
+    if smoothed_rows is not None:
+        smoothed_rows = normalize_rows(smoothed_rows)
+    else:
+        if not smoothed_path.exists():
+            raise FileNotFoundError(f"Smoothed world state not found: {smoothed_path}")
+        print(f"Loading smoothed from: {smoothed_path}")
+        smoothed_rows = load_smoothed_world(smoothed_path)
 
     # 1) Re-inject short GO bursts
     final_rows = reinject_go_short(raw_map, smoothed_rows)
 
-    final_path = preds_root / "world_state_final.csv"
+    final_path = out_dir / "world_state_final.csv"
     # save final frame-level world state
     if final_rows:
         fieldnames = list(final_rows[0].keys())
         write_csv(final_path, fieldnames, final_rows)
         print(f"Saved final frame-level world state (with GO reinjected) to {final_path}")
 
-    # 2) Build symbolic state machine segments
-    segs = segment_states(final_rows)
-    segs = add_prev_next(segs)
-
-    machine_path = preds_root / "world_state_machine.csv"
-    if segs:
-        machine_fields = [
-            "clip",
-            "segment_id",
-            "start_frame",
-            "end_frame",
-            "state",
-            "prev_state",
-            "next_state",
-            "affordance",
-            "yield_to",
-            "lead_state",
-        ]
-        write_csv(machine_path, machine_fields, segs)
-        print(f"Saved symbolic state machine to {machine_path}")
-
-    # 3) Build planner abstraction
+    # 2) + 3) Write each segment and its planner row as soon as it is closed.
+    # The rows are also collected, since PlannerOutputs returns them in memory.
+    machine_path = out_dir / "world_state_machine.csv"
+    planner_path = out_dir / "planner_commands.csv"
+    machine_fields = [
+        "clip",
+        "segment_id",
+        "start_frame",
+        "end_frame",
+        "state",
+        "prev_state",
+        "next_state",
+        "affordance",
+        "yield_to",
+        "lead_state",
+    ]
+    planner_fields = [
+        "clip",
+        "segment_id",
+        "start_frame",
+        "end_frame",
+        "state",
+        "prev_state",
+        "next_state",
+        "planner_cmd",
+        "reason",
+        "target",
+        "until",
+    ]
+
+    segs: List[Dict[str, Any]] = []
     planner_rows: List[Dict[str, Any]] = []
-    for seg in segs:
-        st = seg["state"]
-        planner_info = map_state_to_planner(st)
-        r = dict(seg)
-        r.update(planner_info)
-        planner_rows.append(r)
-
-    planner_path = preds_root / "planner_commands.csv"
-    if planner_rows:
-        planner_fields = [
-            "clip",
-            "segment_id",
-            "start_frame",
-            "end_frame",
-            "state",
-            "prev_state",
-            "next_state",
-            "planner_cmd",
-            "reason",
-            "target",
-            "until",
-        ]
-        write_csv(planner_path, planner_fields, planner_rows)
+    if final_rows:
+        with machine_path.open("w", newline="") as fm, planner_path.open("w", newline="") as fp:
+            machine_writer = csv.DictWriter(fm, fieldnames=machine_fields, extrasaction="ignore")
+            planner_writer = csv.DictWriter(fp, fieldnames=planner_fields, extrasaction="ignore")
+            machine_writer.writeheader()
+            planner_writer.writeheader()
+
+            for seg in segment_states(final_rows):
+                r = {**seg, **map_state_to_planner(seg["state"])}
+                machine_writer.writerow(seg)
+                planner_writer.writerow(r)
+                segs.append(seg)
+                planner_rows.append(r)
+
+        print(f"Saved symbolic state machine to {machine_path}")
         print(f"Saved planner command sequence to {planner_path}")
 
+    return PlannerOutputs(final_rows=final_rows, segments=segs, planner_rows=planner_rows)
+
+
+def main():
+    project_root = Path(__file__).resolve().parents[1]
+    preds_root = project_root / "data" / "predictions"
+
+    raw_path = preds_root / "world_state_claude.csv"
+    smoothed_path = preds_root / "world_state_claude_smoothed.csv"
+
+    run(raw_path, smoothed_path, preds_root)
+
 
 if __name__ == "__main__":
     main()
@@ -1,11 +1,64 @@
 import argparse
 import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
+from typing import Optional
 
 import cv2
 from tqdm import tqdm
 
 
+# JPEG encode + disk write happen on writer threads (cv2.imwrite releases the
+# GIL) so decoding the next frame doesn't wait on them. In-flight writes are
+# bounded so a long video can't queue up unbounded decoded frames in RAM.
+WRITER_THREADS = 4
+MAX_PENDING_WRITES = 8
+
+
+def find_ffmpeg() -> Optional[str]:
+    """ffmpeg on PATH, else the binary bundled with imageio-ffmpeg."""
+    exe = shutil.which("ffmpeg")
+    if exe:
+        return exe
+    try:
+        import imageio_ffmpeg
+    except ImportError:
+        return None
+    try:
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except RuntimeError:
+        return None
+
+
+def extract_frames_with_ffmpeg(ffmpeg: str, video_path: Path, video_output_dir: Path, frame_interval: int) -> int:
+    """
+    Decode, sample and JPEG-encode in a single ffmpeg process (hardware
+    decode when available). Keeps every frame_interval-th frame starting at 0,
+    the same frames the OpenCV loop picks, so frame numbering (and the human
+    labels keyed on it) stays aligned. Returns the number of frames written.
+    """
+    subprocess.run(
+        [
+            ffmpeg,
+            "-hide_banner",
+            "-loglevel", "error",
+            "-y",
+            "-hwaccel", "auto",
+            "-i", str(video_path),
+            "-vf", f"select=not(mod(n\\,{frame_interval}))",
+            "-fps_mode", "vfr",
+            "-q:v", "3",
+            str(video_output_dir / "frame_%04d.jpg"),
+        ],
+        check=True,
+    )
+    return sum(1 for _ in video_output_dir.glob("frame_*.jpg"))
+
+
 def extract_frames_from_video(video_path: Path, output_dir: Path, fps: float, overwrite: bool = False) -> None:
     if not video_path.is_file():
         print(f"[WARN] Video not found: {video_path}")
@@ -39,30 +92,79 @@ def extract_frames_from_video(video_path: Path, output_dir: Path, fps: float, ov
         cap.release()
         return
 
+    ffmpeg = find_ffmpeg()
+    if ffmpeg is not None:
+        cap.release()
+        print(f"[INFO] Extracting frames from {video_path.name} at ~{fps} fps into {video_output_dir} (ffmpeg)")
+        try:
+            saved = extract_frames_with_ffmpeg(ffmpeg, video_path, video_output_dir, frame_interval)
+            print(f"[INFO] Saved {saved} frames for {video_id}.")
+            return
+        except subprocess.CalledProcessError as e:
+            print(f"[WARN] ffmpeg failed with exit code {e.returncode} for {video_path}, falling back to OpenCV")
+            cap = cv2.VideoCapture(str(video_path))
+
     print(f"[INFO] Extracting frames from {video_path.name} at ~{fps} fps into {video_output_dir}")
 
     frame_idx = 0
     saved_idx = 0
 
+    writer_pool = ThreadPoolExecutor(max_workers=WRITER_THREADS)
+    pending_writes = threading.BoundedSemaphore(MAX_PENDING_WRITES)
+    writes = []
+
     with tqdm(total=total_frames, desc=f"{video_id}", unit="frame") as pbar:
         while True:
-            ret, frame = cap.read()
-            if not ret:
+            # grab() only advances the stream; the BGR conversion and array
+            # allocation in retrieve() are paid just for the sampled frames.
+            if not cap.grab():
                 break
 
             if frame_idx % frame_interval == 0:
+                ret, frame = cap.retrieve()
+                if not ret:
+                    break
+
                 saved_idx += 1
                 filename = f"frame_{saved_idx:04d}.jpg"
                 out_path = video_output_dir / filename
-                cv2.imwrite(str(out_path), frame)
+                # retrieve() hands back a fresh array each call, so the
+                # writer thread can own `frame` without a copy.
+                pending_writes.acquire()
+                fut = writer_pool.submit(cv2.imwrite, str(out_path), frame)
+                fut.add_done_callback(lambda _: pending_writes.release())
+                writes.append(fut)
 
             frame_idx += 1
             pbar.update(1)
 
+    writer_pool.shutdown(wait=True)
     cap.release()
+    for fut in writes:
+        fut.result()  # re-raise any writer error
     print(f"[INFO] Saved {saved_idx} frames for {video_id}.")
 
 
+def run(input_dir: Path, output_dir: Path, fps: float = 2.0, overwrite: bool = False) -> None:
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    if not input_dir.is_dir():
+        print(f"[ERROR] Input directory does not exist: {input_dir}")
+        return
+
+    video_files = sorted(p for p in input_dir.glob("*.mp4"))
+    if not video_files:
+        print(f"[WARN] No .mp4 files found in {input_dir}")
+        return
+
+    # Videos are independent; use half the cores since ffmpeg / the writer
+    # pool already multithread each one.
+    max_workers = min(len(video_files), max(1, (os.cpu_count() or 2) // 2))
+    extract = partial(extract_frames_from_video, output_dir=output_dir, fps=fps, overwrite=overwrite)
+    with ProcessPoolExecutor(max_workers=max_workers) as ex:
+        list(ex.map(extract, video_files))
+
+
 def main():
     parser = argparse.ArgumentParser(description="Extract frames from driving videos.")
     parser.add_argument(
@@ -91,21 +193,7 @@ def main():
 
     args = parser.parse_args()
 
-    input_dir = Path(args.input_dir)
-    output_dir = Path(args.output_dir)
-    output_dir.mkdir(parents=True, exist_ok=True)
-
-    if not input_dir.is_dir():
-        print(f"[ERROR] Input directory does not exist: {input_dir}")
-        return
-
-    video_files = sorted(p for p in input_dir.glob("*.mp4"))
-    if not video_files:
-        print(f"[WARN] No .mp4 files found in {input_dir}")
-        return
-
-    for vid in video_files:
-        extract_frames_from_video(vid, output_dir, fps=args.fps, overwrite=args.overwrite)
+    run(Path(args.input_dir), Path(args.output_dir), fps=args.fps, overwrite=args.overwrite)
 
 
 if __name__ == "__main__":
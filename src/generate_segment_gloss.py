@@ -5,7 +5,7 @@ import csv
 import json
 import os
 from pathlib import Path
-from typing import Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 from anthropic import Anthropic
 
@@ -143,23 +143,28 @@ def call_claude_for_segment(
     return short_label, long_label
 
 
-def main():
-    project_root = Path(__file__).resolve().parents[1]
-    preds_root = project_root / "data" / "predictions"
-    segments_path = preds_root / "world_state_segments.csv"
-    frames_root = project_root / "data" / "frames"
-    out_path = preds_root / "segment_gloss.csv"
-
-    if not segments_path.exists():
-        raise FileNotFoundError(f"Segments file not found: {segments_path}")
+def run(
+    segments_path: Path,
+    frames_root: Path,
+    out_path: Path,
+    segments: Optional[List[Dict[str, Any]]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Generate a short/long gloss for every segment and write them to out_path.
+    Uses the given in-memory segment rows if provided, otherwise reads segments_path.
+    Returns the gloss rows as written.
+    """
+    if segments is None:
+        if not segments_path.exists():
+            raise FileNotFoundError(f"Segments file not found: {segments_path}")
+
+        # Read segments
+        with segments_path.open("r", newline="") as f:
+            reader = csv.DictReader(f)
+            segments = list(reader)
 
     client = Anthropic()
 
-    # Read segments
-    with segments_path.open("r", newline="") as f:
-        reader = csv.DictReader(f)
-        segments = list(reader)
-
     # Prepare output
     fieldnames = [
         "clip",
@@ -174,6 +179,7 @@ def main():
         "gloss_long",
     ]
     out_path.parent.mkdir(parents=True, exist_ok=True)
+    gloss_rows: List[Dict[str, Any]] = []
 
     with out_path.open("w", newline="") as fw:
         writer = csv.DictWriter(fw, fieldnames=fieldnames)
@@ -213,22 +219,33 @@ def main():
                     end=end,
                 )
 
-            writer.writerow(
-                {
-                    "clip": clip,
-                    "segment_id": seg_id,
-                    "start": start,
-                    "end": end,
-                    "affordance": affordance,
-                    "yield_to": yield_to,
-                    "lead_state": lead_state,
-                    "phase": phase,
-                    "gloss_short": gloss_short,
-                    "gloss_long": gloss_long,
-                }
-            )
+            gloss_row = {
+                "clip": clip,
+                "segment_id": seg_id,
+                "start": start,
+                "end": end,
+                "affordance": affordance,
+                "yield_to": yield_to,
+                "lead_state": lead_state,
+                "phase": phase,
+                "gloss_short": gloss_short,
+                "gloss_long": gloss_long,
+            }
+            writer.writerow(gloss_row)
+            gloss_rows.append(gloss_row)
 
     print(f"\nSaved segment glosses to {out_path}")
+    return gloss_rows
+
+
+def main():
+    project_root = Path(__file__).resolve().parents[1]
+    preds_root = project_root / "data" / "predictions"
+    segments_path = preds_root / "world_state_segments.csv"
+    frames_root = project_root / "data" / "frames"
+    out_path = preds_root / "segment_gloss.csv"
+
+    run(segments_path, frames_root, out_path)
 
 
 if __name__ == "__main__":
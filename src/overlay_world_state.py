@@ -1,16 +1,22 @@
 # src/overlay_world_state.py
 
 import argparse
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import os
 from pathlib import Path
 import csv
-from typing import Dict, Tuple
+import subprocess
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import numpy as np
 import cv2
 from PIL import Image, ImageDraw, ImageFont
-from moviepy.video.io.ImageSequenceClip import ImageSequenceClip
 
-from run_yolo import run_yolo, filter_peds, filter_cars
+from .extract_frames import find_ffmpeg
+from .run_yolo import run_yolo, filter_peds, filter_cars
 
 # ============================================================================
 # YOLO Target Selection Heuristic Weights
@@ -32,54 +38,98 @@ PED_ROI_CENTER_WIDTH = 0.33  # Prefer center 1/3 width (front-of-lane)
 
 LEAD_ROI_CENTER_WIDTH = 0.50  # Include center 50% width for lead cars
 
+# Buffer size for CSV loads (fewer read syscalls on large prediction files).
+CSV_BUFFER_SIZE = 1 << 20
 
-def load_smoothed_preds(csv_path: Path) -> Dict[Tuple[str, int], Dict[str, str]]:
+# Frames rendered ahead of the encoder, per render worker.
+RENDER_AHEAD = 4
+
+# Raw frame layout piped to ffmpeg (cv2.imread's channel order).
+VIDEO_PIX_FMT = "bgr24"
+
+
+def index_smoothed_preds(rows: Iterable[Dict[str, Any]]) -> Dict[Tuple[str, int], Dict[str, str]]:
     pred_map: Dict[Tuple[str, int], Dict[str, str]] = {}
-    with csv_path.open("r", newline="") as f:
-        reader = csv.DictReader(f)
+    for row in rows:
+        clip = row["clip"]
+        fi = int(row["frame_index"])
+        key = (clip, fi)
+        pred_map[key] = {
+            "affordance": row.get("affordance_smoothed", row.get("affordance", "")),
+            "yield_to": row.get("yield_to_smoothed", row.get("yield_to", "")),
+            "lead_state": row.get("lead_state_smoothed", row.get("lead_state", "")),
+        }
+    return pred_map
+
+
+def load_smoothed_preds(csv_path: Path) -> Dict[Tuple[str, int], Dict[str, str]]:
+    """
+    Same mapping as index_smoothed_preds, parsed with csv.reader and column
+    indices resolved from the header (no per-row dict).
+    """
+    with csv_path.open("r", newline="", buffering=CSV_BUFFER_SIZE) as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        if not header:
+            return {}
+
+        def col(field: str) -> int:
+            for name in (f"{field}_smoothed", field):
+                if name in header:
+                    return header.index(name)
+            return -1
+
+        clip_i = header.index("clip")
+        fi_i = header.index("frame_index")
+        aff_i, yield_i, lead_i = col("affordance"), col("yield_to"), col("lead_state")
+
+        pred_map: Dict[Tuple[str, int], Dict[str, str]] = {}
         for row in reader:
-            clip = row["clip"]
-            fi = int(row["frame_index"])
-            key = (clip, fi)
-            pred_map[key] = {
-                "affordance": row.get("affordance_smoothed", row.get("affordance", "")),
-                "yield_to": row.get("yield_to_smoothed", row.get("yield_to", "")),
-                "lead_state": row.get("lead_state_smoothed", row.get("lead_state", "")),
+            pred_map[(row[clip_i], int(row[fi_i]))] = {
+                "affordance": row[aff_i] if aff_i >= 0 else "",
+                "yield_to": row[yield_i] if yield_i >= 0 else "",
+                "lead_state": row[lead_i] if lead_i >= 0 else "",
             }
-    return pred_map
+        return pred_map
 
 
-def load_segments(segments_path: Path):
+def index_segments(rows: Iterable[Dict[str, Any]]):
     by_clip = {}
-    with segments_path.open("r", newline="") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            clip = row["clip"]
-            by_clip.setdefault(clip, []).append({
-                "segment_id": int(row["segment_id"]),
-                "start": int(row["start"]),
-                "end": int(row["end"]),
-                "phase": row["phase"],
-            })
+    for row in rows:
+        clip = row["clip"]
+        by_clip.setdefault(clip, []).append({
+            "segment_id": int(row["segment_id"]),
+            "start": int(row["start"]),
+            "end": int(row["end"]),
+            "phase": row["phase"],
+        })
     for clip in by_clip:
         by_clip[clip].sort(key=lambda s: s["start"])
     return by_clip
 
 
-def load_gloss(gloss_path: Path):
+def load_segments(segments_path: Path):
+    with segments_path.open("r", newline="", buffering=CSV_BUFFER_SIZE) as f:
+        return index_segments(csv.DictReader(f))
+
+
+def index_gloss(rows: Iterable[Dict[str, Any]]):
     gmap = {}
-    with gloss_path.open("r", newline="") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            key = (row["clip"], int(row["segment_id"]))
-            gmap[key] = {
-                "gloss_short": row.get("gloss_short", "").strip(),
-                "gloss_long": row.get("gloss_long", "").strip(),
-            }
+    for row in rows:
+        key = (row["clip"], int(row["segment_id"]))
+        gmap[key] = {
+            "gloss_short": row.get("gloss_short", "").strip(),
+            "gloss_long": row.get("gloss_long", "").strip(),
+        }
     return gmap
 
 
-def load_planner(planner_path: Path):
+def load_gloss(gloss_path: Path):
+    with gloss_path.open("r", newline="", buffering=CSV_BUFFER_SIZE) as f:
+        return index_gloss(csv.DictReader(f))
+
+
+def index_planner(rows: Iterable[Dict[str, Any]]):
     """
     Returns (clip, segment_id) -> planner dict:
     {
@@ -89,37 +139,55 @@ def load_planner(planner_path: Path):
     }
     """
     pmap = {}
-    with planner_path.open("r", newline="") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            clip = row["clip"]
-            seg_id = int(row["segment_id"])
-            behavior = row.get("planner_cmd", "").strip().upper()
-
-            target = row.get("target", "").strip()
-            until = row.get("until", "").strip()
-
-            if target and until:
-                intent = f"{behavior.title()}({target}) until {until}"
-            elif target:
-                intent = f"{behavior.title()}({target})"
-            else:
-                intent = behavior.title()
-
-            pmap[(clip, seg_id)] = {
-                "behavior": behavior,
-                "intent": intent,
-                "target": target,
-            }
+    for row in rows:
+        clip = row["clip"]
+        seg_id = int(row["segment_id"])
+        behavior = row.get("planner_cmd", "").strip().upper()
+
+        target = row.get("target", "").strip()
+        until = row.get("until", "").strip()
+
+        if target and until:
+            intent = f"{behavior.title()}({target}) until {until}"
+        elif target:
+            intent = f"{behavior.title()}({target})"
+        else:
+            intent = behavior.title()
+
+        pmap[(clip, seg_id)] = {
+            "behavior": behavior,
+            "intent": intent,
+            "target": target,
+        }
     return pmap
 
 
-def find_segment(clip: str, frame_index: int, segments) -> Tuple[int, str]:
+def load_planner(planner_path: Path):
+    with planner_path.open("r", newline="", buffering=CSV_BUFFER_SIZE) as f:
+        return index_planner(csv.DictReader(f))
+
+
+SegmentTable = Tuple[List[int], List[int], List[int], List[str]]  # starts, ends, ids, phases
+
+
+def segment_table(clip: str, segments) -> SegmentTable:
+    """Parallel lists over a clip's segments (already sorted by start)."""
     segs = segments.get(clip, [])
-    for seg in segs:
-        if seg["start"] <= frame_index <= seg["end"]:
-            return seg["segment_id"], seg["phase"]
-    return -1, "UNKNOWN"
+    return (
+        [s["start"] for s in segs],
+        [s["end"] for s in segs],
+        [s["segment_id"] for s in segs],
+        [s["phase"] for s in segs],
+    )
+
+
+def segment_position(frame_index: int, table: SegmentTable) -> int:
+    """O(log S): index of the segment containing frame_index, or -1."""
+    starts, ends, _, _ = table
+    i = bisect_right(starts, frame_index) - 1
+    if i >= 0 and frame_index <= ends[i]:
+        return i
+    return -1
 
 
 def collect_frame_paths(frames_dir: Path):
@@ -131,19 +199,28 @@ def collect_frame_paths(frames_dir: Path):
     return paths
 
 
-def draw_hud(img, clip_name, frame_index, state):
-    if img.mode != "RGB":
-        img = img.convert("RGB")
-
-    draw = ImageDraw.Draw(img)
-    W, H = img.size
-
-    base_font_size = max(18, min(40, H // 28))
+@lru_cache(maxsize=32)
+def _load_font(size: int):
+    """HUD font at the given size, parsed once per process."""
     try:
-        font = ImageFont.truetype("Menlo.ttf", base_font_size)
+        return ImageFont.truetype("Menlo.ttf", size)
     except Exception:
-        font = ImageFont.load_default()
+        return ImageFont.load_default()
+
+
+# 1x1 RGB canvas used only for text measurement (same font mode as the frames).
+_MEASURE_DRAW = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+
+
+@lru_cache(maxsize=1024)
+def _text_size(font_size: int, line: str) -> Tuple[int, int]:
+    """(width, height) of a HUD line; most lines repeat across frames."""
+    bbox = _MEASURE_DRAW.textbbox((0, 0), line, font=_load_font(font_size))
+    return bbox[2] - bbox[0], bbox[3] - bbox[1]
 
+
+def hud_lines(clip_name, frame_index, state) -> List[str]:
+    """HUD text lines, top to bottom. Only the first one changes every frame."""
     # HUD lines (clean cognitive order)
     lines = [
         f"CLIP: {clip_name}  FRAME: {frame_index}",
@@ -166,47 +243,64 @@ def draw_hud(img, clip_name, frame_index, state):
     if intent:
         lines.append(f"INTENT: {intent}")
 
-    def text_size(line):
-        bbox = draw.textbbox((0, 0), line, font=font)
-        return bbox[2]-bbox[0], bbox[3]-bbox[1]
+    return lines
+
 
-    text_w = 0
-    text_h = 0
-    for line in lines:
-        w, h = text_size(line)
-        text_w = max(text_w, w)
-        text_h += h + 6
+@lru_cache(maxsize=256)
+def _hud_patch(font_size: int, first_h: int, rest: Tuple[str, ...], box_w: int, box_h: int) -> np.ndarray:
+    """
+    The HUD box as a (box_h + 1, box_w + 1, 3) array: black, with every line
+    after the first drawn in white. Consecutive frames of a segment share it.
+    White on black is the same in RGB and BGR.
+    """
+    patch = Image.new("RGB", (box_w + 1, box_h + 1), (0, 0, 0))
+    draw = ImageDraw.Draw(patch)
+    font = _load_font(font_size)
+    y = 20 + first_h + 6
+    for line in rest:
+        draw.text((20, y), line, fill=(255, 255, 255), font=font)
+        y += _text_size(font_size, line)[1] + 6
+    patch_np = np.asarray(patch)
+    patch_np.flags.writeable = False
+    return patch_np
+
+
+def blit_hud(frame: np.ndarray, clip_name, frame_index, state) -> np.ndarray:
+    """
+    Draw the HUD box into the top-left of an HxWx3 uint8 frame, in place.
+    The cached per-state patch is copied in; only the CLIP/FRAME line is
+    rendered per frame.
+    """
+    H, W = frame.shape[:2]
 
-    box_w = text_w + 40
-    box_h = text_h + 40
-    box_coords = (10, 10, 10 + box_w, 10 + box_h)
+    font_size = max(18, min(40, H // 28))
+    lines = hud_lines(clip_name, frame_index, state)
+    metrics = [_text_size(font_size, line) for line in lines]
+    box_w = max(w for w, _ in metrics) + 40
+    box_h = sum(h + 6 for _, h in metrics) + 40
 
-    draw.rectangle(box_coords, fill=(0, 0, 0))
-    y = box_coords[1] + 20
-    x = box_coords[0] + 20
-    for line in lines:
-        draw.text((x, y), line, fill=(255, 255, 255), font=font)
-        _, h = text_size(line)
-        y += h + 6
+    box = Image.fromarray(_hud_patch(font_size, metrics[0][1], tuple(lines[1:]), box_w, box_h))
+    ImageDraw.Draw(box).text((20, 20), lines[0], fill=(255, 255, 255), font=_load_font(font_size))
 
-    return img
+    # The box is anchored at (10, 10) and clipped to the frame.
+    rh = max(0, min(box_h + 1, H - 10))
+    rw = max(0, min(box_w + 1, W - 10))
+    frame[10:10 + rh, 10:10 + rw] = np.asarray(box)[:rh, :rw]
+    return frame
 
 
-def draw_yolo_target(img, target_box, object_label):
+def draw_yolo_target(img_np, target_box, object_label):
     """
-    Draw a green box and label around the target object.
+    Draw a green box and label around the target object, in place.
     
     Args:
-        img: PIL Image (RGB)
+        img_np: HxWx3 uint8 frame (RGB or BGR; the colors used are the same in both)
         target_box: dict with 'xyxy' key containing (x1, y1, x2, y2)
         object_label: string label for the object (e.g., "PEDESTRIAN", "CAR")
     
     Returns:
-        PIL Image with box drawn
+        The same array, with the box drawn
     """
-    # Convert PIL to numpy array for cv2
-    img_np = np.array(img)
-    
     x1, y1, x2, y2 = target_box['xyxy']
     
     # Draw green rectangle (BGR format for cv2)
@@ -234,8 +328,7 @@ def draw_yolo_target(img, target_box, object_label):
                   (0, 0, 0), -1)  # Black background
     cv2.putText(img_np, label, (label_x, label_y), font, font_scale, color, label_thickness)
     
-    # Convert back to PIL Image
-    return Image.fromarray(img_np)
+    return img_np
 
 
 def select_pedestrian_target(peds: list, frame_width: int, frame_height: int) -> Dict:
@@ -377,85 +470,191 @@ def select_lead_car_target(cars: list, frame_width: int, frame_height: int) -> D
     return scores[0][1] if scores else None
 
 
-def make_overlay_video_for_clip(clip_name, frames_root, preds, segments, gloss, planner, out_dir, fps=2):
-    frames_dir = frames_root / clip_name
-    frame_paths = collect_frame_paths(frames_dir)
+# HUD fields and planner target for frames outside every segment.
+_NO_SEGMENT: Tuple[Dict[str, str], str] = (
+    {"phase": "UNKNOWN", "gloss_short": "", "behavior": "", "intent": ""},
+    "",
+)
 
-    frames = []
-    for idx, frame_path in enumerate(frame_paths):
-        frame_index = idx
-        key = (clip_name, frame_index)
-
-        base = preds.get(key, {"affordance":"N/A","yield_to":"N/A","lead_state":"N/A"})
-
-        seg_id, phase = find_segment(clip_name, frame_index, segments)
-        gloss_short = ""
-        behavior = ""
-        intent = ""
-        target = ""
-
-        if seg_id >= 0:
-            g = gloss.get((clip_name, seg_id))
-            if g:
-                gloss_short = g.get("gloss_short", "")
-            p = planner.get((clip_name, seg_id))
-            if p:
-                behavior = p.get("behavior","")
-                intent = p.get("intent","")
-                target = p.get("target","")
-
-        state = {
-            **base,
-            "phase": phase,
-            "gloss_short": gloss_short,
-            "behavior": behavior,
-            "intent": intent,
-        }
 
-        img = Image.open(frame_path).convert("RGB")
+def segment_hud_states(clip_name, seg_table: SegmentTable, gloss, planner) -> List[Tuple[Dict[str, str], str]]:
+    """
+    Per segment (same order as seg_table): the HUD fields shared by all of its
+    frames, and the planner target ("" for none).
+    """
+    states = []
+    for seg_id, phase in zip(seg_table[2], seg_table[3]):
+        g = gloss.get((clip_name, seg_id)) or {}
+        p = planner.get((clip_name, seg_id)) or {}
+        states.append((
+            {
+                "phase": phase,
+                "gloss_short": g.get("gloss_short", ""),
+                "behavior": p.get("behavior", ""),
+                "intent": p.get("intent", ""),
+            },
+            p.get("target", ""),
+        ))
+    return states
+
+
+def frame_state(clip_name, frame_index, preds, seg_table, seg_states) -> Tuple[Dict[str, str], str]:
+    """HUD state for one frame, plus the planner target ("" for none)."""
+    base = preds.get((clip_name, frame_index), {"affordance":"N/A","yield_to":"N/A","lead_state":"N/A"})
+
+    i = segment_position(frame_index, seg_table)
+    seg_state, target = seg_states[i] if i >= 0 else _NO_SEGMENT
+    return {**base, **seg_state}, target
+
+
+def _render_frame(frame_path, clip_name, frame_index, state, target) -> bytes:
+    """
+    Load one frame, draw the YOLO target (if any) and the HUD, and return the
+    raw BGR bytes (see VIDEO_PIX_FMT). Runs in render worker processes.
+    """
+    behavior = state["behavior"]
+    # Decoded straight to an ndarray and drawn on in place (BGR, as cv2 reads it).
+    frame = cv2.imread(str(frame_path), cv2.IMREAD_COLOR)
+    if frame is None:
+        raise ValueError(f"Could not read frame {frame_path}")
+    
+    # Run YOLO and highlight target if needed
+    if behavior and target:
+        # Run YOLO inference (on RGB, as before)
+        boxes = run_yolo(np.ascontiguousarray(frame[:, :, ::-1]))
+        
+        frame_height, frame_width = frame.shape[:2]
         
-        # Run YOLO and highlight target if needed
-        if behavior and target:
-            # Convert PIL to numpy for YOLO
-            img_np = np.array(img)
-            
-            # Run YOLO inference
-            boxes = run_yolo(img_np)
-            
-            frame_width = img.size[0]
-            frame_height = img.size[1]
-            
-            # Determine which objects to highlight based on target and behavior
-            target_box = None
-            object_label = None
-            
-            if target == "ped" and behavior in ["WAIT", "STOP"]:
-                # Highlight pedestrian using improved heuristics
-                peds = filter_peds(boxes)
-                target_box = select_pedestrian_target(peds, frame_width, frame_height)
-                if target_box:
-                    object_label = "PEDESTRIAN"
-            
-            elif target == "lead" and behavior in ["FOLLOW", "STOP"]:
-                # Highlight car using improved heuristics
-                cars = filter_cars(boxes)
-                target_box = select_lead_car_target(cars, frame_width, frame_height)
-                if target_box:
-                    object_label = "CAR"
-            
-            # Draw target box if found
-            if target_box and object_label:
-                img = draw_yolo_target(img, target_box, object_label)
+        # Determine which objects to highlight based on target and behavior
+        target_box = None
+        object_label = None
         
-        img = draw_hud(img, clip_name, frame_index, state)
-        frames.append(img)
+        if target == "ped" and behavior in ["WAIT", "STOP"]:
+            # Highlight pedestrian using improved heuristics
+            peds = filter_peds(boxes)
+            target_box = select_pedestrian_target(peds, frame_width, frame_height)
+            if target_box:
+                object_label = "PEDESTRIAN"
+        
+        elif target == "lead" and behavior in ["FOLLOW", "STOP"]:
+            # Highlight car using improved heuristics
+            cars = filter_cars(boxes)
+            target_box = select_lead_car_target(cars, frame_width, frame_height)
+            if target_box:
+                object_label = "CAR"
+        
+        # Draw target box if found
+        if target_box and object_label:
+            draw_yolo_target(frame, target_box, object_label)
+    
+    return blit_hud(frame, clip_name, frame_index, state).tobytes()
+
+
+def limit_threads(n: int = 1) -> None:
+    """
+    Pool initializer: cap torch (YOLO) at n intra-op threads and turn off
+    OpenCV's own threading, so parallel render processes don't oversubscribe
+    the cores.
+    """
+    cv2.setNumThreads(0)
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(n)
+
+
+def _render_frames(jobs: Iterable[Tuple[Any, ...]], workers: int) -> Iterator[bytes]:
+    """
+    Yield _render_frame(*job) for each job, in order. With workers > 1 frames
+    render in a process pool, at most workers * RENDER_AHEAD ahead of the consumer.
+    """
+    if workers <= 1:
+        for job in jobs:
+            yield _render_frame(*job)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=limit_threads) as ex:
+        pending = deque()
+        for job in jobs:
+            pending.append(ex.submit(_render_frame, *job))
+            if len(pending) >= workers * RENDER_AHEAD:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def open_video_pipe(out_path: Path, width: int, height: int, fps: float) -> subprocess.Popen:
+    """
+    Start an ffmpeg process that encodes raw VIDEO_PIX_FMT frames written to its stdin
+    into an H.264 mp4 at out_path.
+    """
+    ffmpeg = find_ffmpeg()
+    if ffmpeg is None:
+        raise RuntimeError("ffmpeg not found: install it or the imageio-ffmpeg package")
+    cmd = [
+        ffmpeg, "-y", "-loglevel", "error",
+        "-f", "rawvideo", "-pix_fmt", VIDEO_PIX_FMT,
+        "-s", f"{width}x{height}", "-r", str(fps),
+        "-i", "-",
+        "-c:v", "libx264",
+    ]
+    # libx264 rejects yuv420p for odd frame sizes; like MoviePy, only force
+    # it (for broad player support) when both dimensions are even.
+    if width % 2 == 0 and height % 2 == 0:
+        cmd += ["-pix_fmt", "yuv420p"]
+    cmd.append(str(out_path))
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def close_video_pipe(proc: subprocess.Popen, out_path: Path) -> None:
+    """Close ffmpeg's stdin, wait for it to finish and surface any failure."""
+    _, err = proc.communicate()
+    if proc.returncode != 0:
+        msg = err.decode(errors="replace").strip()
+        raise RuntimeError(f"ffmpeg failed writing {out_path}: {msg}")
+
+
+def make_overlay_video_for_clip(clip_name, frames_root, preds, segments, gloss, planner, out_dir, fps=2, workers: Optional[int] = None):
+    """
+    Render the HUD overlay for every frame of a clip and encode it to
+    out_dir/<clip>_overlay.mp4. Frames render on `workers` processes
+    (default: all cores; 1 renders in-process) and stream to ffmpeg in order.
+    """
+    frames_dir = frames_root / clip_name
+    frame_paths = collect_frame_paths(frames_dir)
+    seg_table = segment_table(clip_name, segments)
+    seg_states = segment_hud_states(clip_name, seg_table, gloss, planner)
+    workers = workers or os.cpu_count() or 1
 
-    frames_np = [np.array(im) for im in frames]
     out_dir.mkdir(parents=True, exist_ok=True)
     out_path = out_dir / f"{clip_name}_overlay.mp4"
 
-    clip = ImageSequenceClip(frames_np, fps=fps)
-    clip.write_videofile(str(out_path), codec="libx264")
+    # YOLO boxes and the HUD are drawn in place, so every frame keeps the
+    # size of the first one (only its header is read here).
+    with Image.open(frame_paths[0]) as first:
+        width, height = first.size
+
+    jobs = (
+        (frame_path, clip_name, idx, *frame_state(clip_name, idx, preds, seg_table, seg_states))
+        for idx, frame_path in enumerate(frame_paths)
+    )
+    frames = _render_frames(jobs, workers)
+
+    proc = open_video_pipe(out_path, width, height, fps)
+    try:
+        for frame_bytes in frames:
+            proc.stdin.write(frame_bytes)
+    except BrokenPipeError:
+        pass  # ffmpeg exited; close_video_pipe reports why
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        frames.close()
+
+    close_video_pipe(proc, out_path)
     print(f"Saved overlay video to {out_path}")
 
 
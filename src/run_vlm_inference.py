@@ -1,8 +1,13 @@
 # src/run_vlm_inference.py
 
+import asyncio
 import csv
+import json
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
 
 from .vlm_infer import VLMWorldModel
 
@@ -13,61 +18,273 @@ def list_frames(dir_path: Path) -> List[Path]:
     return sorted(files)
 
 
-def main():
-    project_root = Path(__file__).resolve().parents[1]
-    frames_root = project_root / "data" / "frames"
-    preds_root = project_root / "data" / "predictions"
-    preds_root.mkdir(parents=True, exist_ok=True)
+CLIPS = ["clip1", "clip2", "clip3"]
+
+# Batch server knobs:
+#   BATCH_SIZE    (N)     - max frames packed into one API request
+#   BATCH_MAX     (B_max) - max requests in flight
+#   BATCH_TIMEOUT (tau)   - seconds the server waits for a batch to fill before flushing
+BATCH_SIZE = 8
+BATCH_MAX = 8
+BATCH_TIMEOUT = 0.1
+
+# A frame whose dHash is within DEDUP_MAX_DISTANCE bits of the last frame sent
+# to the VLM (same clip) reuses that frame's prediction instead of a new call.
+DEDUP_MAX_DISTANCE = 4
+
+# Columns of the predictions CSV, i.e. everything the downstream stages read.
+# Explanations and raw model answers go to a JSONL sidecar (raw_sidecar_path).
+PRED_FIELDS = ["clip", "frame_index", "affordance", "yield_to", "lead_state"]
+
+# The raw predictions CSV is written in one writerows call through a 1 MiB buffer.
+CSV_BUFFER_SIZE = 1 << 20
+
+# (clip, frame_index, frame_path)
+FrameJob = Tuple[str, int, Path]
+
+
+def raw_sidecar_path(out_path: Path) -> Path:
+    """world_state_claude.csv -> world_state_claude_raw.jsonl"""
+    return out_path.with_name(f"{out_path.stem}_raw.jsonl")
+
+
+def frame_dhash(path: Path) -> int:
+    """64-bit difference hash: sign of horizontal gradients on a 9x8 grayscale thumbnail."""
+    with Image.open(path) as im:
+        im.draft("L", (64, 64))
+        px = np.asarray(im.convert("L").resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    return int.from_bytes(np.packbits(px[:, 1:] > px[:, :-1]).tobytes(), "big")
+
+
+def dedup_frames(frames: List[Path], max_distance: int) -> List[int]:
+    """
+    For each frame, the index of the frame whose prediction it should use:
+    itself if it has to be inferred, else the last inferred frame it is a
+    near-duplicate of. Comparing against that anchor (not just the previous
+    frame) keeps slow drift from chaining into one long reused prediction.
+    """
+    sources: List[int] = []
+    anchor_idx, anchor_hash = -1, None
+    for idx, frame_path in enumerate(frames):
+        try:
+            h = frame_dhash(frame_path)
+        except OSError:
+            h = None
+        if h is not None and anchor_hash is not None and bin(h ^ anchor_hash).count("1") <= max_distance:
+            sources.append(anchor_idx)
+            continue
+        anchor_idx, anchor_hash = idx, h
+        sources.append(idx)
+    return sources
+
+
+async def _batch_server(
+    wm: VLMWorldModel,
+    q_req: "asyncio.Queue[Optional[FrameJob]]",
+    q_out: "asyncio.Queue[Tuple[FrameJob, Dict[str, str]]]",
+    batch_size: int,
+    batch_max: int,
+    batch_timeout: float,
+) -> None:
+    """
+    Pop up to batch_size jobs from q_req (waiting at most batch_timeout for the
+    batch to fill), send them as one multi-image request and push results onto
+    q_out. At most batch_max requests are in flight. A None job means the
+    producer is done.
+
+    If a batched request still fails after the model's retries, its frames are
+    re-sent one per request, so only a frame that fails on its own gets an
+    {"error": ...} result; run() fails the stage once everything has finished.
+    """
+    loop = asyncio.get_running_loop()
+    in_flight = asyncio.Semaphore(batch_max)
+    tasks = []
+
+    async def infer_one(job: FrameJob) -> Dict[str, str]:
+        async with in_flight:
+            try:
+                return await wm.ainfer_frame(job[2])
+            except Exception as e:
+                print(f"[{job[0]}] FAILED {job[2].name}: {type(e).__name__}: {e}")
+                return {"error": f"{type(e).__name__}: {e}"}
+
+    async def infer(batch: List[FrameJob]) -> None:
+        results: Optional[List[Dict[str, str]]] = None
+        async with in_flight:
+            try:
+                results = await wm.ainfer_frames([job[2] for job in batch])
+            except Exception as e:
+                names = ", ".join(job[2].name for job in batch)
+                print(f"[{batch[0][0]}] batch {names} failed ({type(e).__name__}: {e}); retrying frames one by one")
+        if results is None:
+            results = await asyncio.gather(*(infer_one(job) for job in batch))
+        for job, result in zip(batch, results):
+            await q_out.put((job, result))
+
+    done = False
+    while not done:
+        job = await q_req.get()
+        if job is None:
+            break
+
+        batch = [job]
+        deadline = loop.time() + batch_timeout
+        while len(batch) < batch_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                job = await asyncio.wait_for(q_req.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if job is None:
+                done = True
+                break
+            batch.append(job)
 
-    clips = ["clip1", "clip2", "clip3"]
+        tasks.append(asyncio.create_task(infer(batch)))
+
+    await asyncio.gather(*tasks)
+
+
+async def _infer_all(
+    wm: VLMWorldModel,
+    jobs: List[FrameJob],
+    batch_size: int = BATCH_SIZE,
+    batch_max: int = BATCH_MAX,
+    batch_timeout: float = BATCH_TIMEOUT,
+) -> Dict[Tuple[str, int], Dict[str, str]]:
+    q_req: "asyncio.Queue[Optional[FrameJob]]" = asyncio.Queue()
+    q_out: "asyncio.Queue[Tuple[FrameJob, Dict[str, str]]]" = asyncio.Queue()
+
+    server = asyncio.create_task(_batch_server(wm, q_req, q_out, batch_size, batch_max, batch_timeout))
+    for job in jobs:
+        await q_req.put(job)
+    await q_req.put(None)
+
+    results: Dict[Tuple[str, int], Dict[str, str]] = {}
+    while len(results) < len(jobs):
+        get_result = asyncio.ensure_future(q_out.get())
+        await asyncio.wait({get_result, server}, return_when=asyncio.FIRST_COMPLETED)
+        if not get_result.done():
+            # Server finished early: surface its exception.
+            get_result.cancel()
+            server.result()
+            continue
+        (clip, idx, frame_path), result = get_result.result()
+        results[(clip, idx)] = result
+        print(f"[{clip}] {len(results)}/{len(jobs)} done -> {frame_path.name}")
+
+    await server
+    return results
+
+
+def run(
+    frames_root: Path,
+    out_path: Path,
+    clips: Optional[List[str]] = None,
+    dedup_distance: Optional[int] = DEDUP_MAX_DISTANCE,
+) -> List[Dict[str, Any]]:
+    """
+    Run the VLM over every frame of each clip and write the raw world state CSV
+    (PRED_FIELDS only) plus its explanation/raw-answer JSONL sidecar.
+    Near-duplicate consecutive frames (see dedup_frames) reuse an earlier
+    prediction; dedup_distance=None sends every frame. The rest are queued up
+    front and sent BATCH_SIZE per request by an asyncio server.
+    Returns the written CSV rows.
+
+    If any frame still fails after retries, only the sidecar is written (with
+    each failed frame's error) and RuntimeError is raised, so the stage fails
+    instead of producing unlabeled rows. Successful frames stay in the
+    VLMWorldModel result cache, so a re-run only retries the failures.
+    """
+    clips = clips or CLIPS
+    out_path.parent.mkdir(parents=True, exist_ok=True)
 
     wm = VLMWorldModel()
 
-    out_path = preds_root / "world_state_claude.csv"
-
-    fieldnames = [
-        "clip",
-        "frame_index",
-        "frame_filename",
-        "frame_path",
-        "affordance",
-        "yield_to",
-        "lead_state",
-        "explanation",
-        "raw",
-    ]
-
-    with out_path.open("w", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
+    jobs: List[FrameJob] = []
+    infer_jobs: List[FrameJob] = []
+    reused: Dict[Tuple[str, int], Tuple[str, int]] = {}
+    for clip in clips:
+        clip_dir = frames_root / clip
+        if not clip_dir.exists():
+            print(f"Skipping {clip}: {clip_dir} does not exist")
+            continue
+
+        frames = list_frames(clip_dir)
+        print(f"Processing {clip}: {len(frames)} frames")
+        jobs.extend((clip, idx, frame_path) for idx, frame_path in enumerate(frames))
+
+        if dedup_distance is None:
+            sources = list(range(len(frames)))
+        else:
+            sources = dedup_frames(frames, dedup_distance)
+        for idx, (frame_path, src) in enumerate(zip(frames, sources)):
+            if src == idx:
+                infer_jobs.append((clip, idx, frame_path))
+            else:
+                reused[(clip, idx)] = (clip, src)
 
-        for clip in clips:
-            clip_dir = frames_root / clip
-            if not clip_dir.exists():
-                print(f"Skipping {clip}: {clip_dir} does not exist")
-                continue
+    if jobs:
+        print(
+            f"Near-duplicate frames reusing a prediction: {len(reused)}/{len(jobs)} "
+            f"({100.0 * len(reused) / len(jobs):.1f}%)"
+        )
 
-            frames = list_frames(clip_dir)
-            print(f"Processing {clip}: {len(frames)} frames")
+    results = asyncio.run(_infer_all(wm, infer_jobs))
+    for key, src in reused.items():
+        results[key] = results[src]
 
-            for idx, frame_path in enumerate(frames):
-                print(f"[{clip}] {idx+1}/{len(frames)} -> {frame_path.name}")
-                result = wm.infer_frame(frame_path)
+    failed = [key for key, result in results.items() if "error" in result]
 
-                row = {
+    rows: List[Dict[str, Any]] = []
+    raw_path = raw_sidecar_path(out_path)
+
+    with raw_path.open("w", encoding="utf-8", buffering=CSV_BUFFER_SIZE) as fr:
+        for clip, idx, frame_path in jobs:
+            result = results[(clip, idx)]
+            rows.append(
+                {
                     "clip": clip,
                     "frame_index": idx,
-                    "frame_filename": frame_path.name,
-                    "frame_path": str(frame_path),
                     "affordance": result.get("affordance", ""),
                     "yield_to": result.get("yield_to", ""),
                     "lead_state": result.get("lead_state", ""),
-                    "explanation": result.get("explanation", ""),
-                    "raw": result.get("raw", ""),
                 }
-                writer.writerow(row)
+            )
+            record = {
+                "clip": clip,
+                "frame_index": idx,
+                "frame_filename": frame_path.name,
+                "explanation": result.get("explanation", ""),
+                "raw": result.get("raw", ""),
+            }
+            if "error" in result:
+                record["error"] = result["error"]
+            fr.write(json.dumps(record) + "\n")
+
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)}/{len(jobs)} frames failed VLM inference "
+            f"(errors in {raw_path}); {out_path.name} not written"
+        )
+
+    with out_path.open("w", newline="", buffering=CSV_BUFFER_SIZE) as f:
+        writer = csv.DictWriter(f, fieldnames=PRED_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print(f"Saved predictions to {out_path} (explanations in {raw_path.name})")
+    return rows
+
+
+def main():
+    project_root = Path(__file__).resolve().parents[1]
+    frames_root = project_root / "data" / "frames"
+    preds_root = project_root / "data" / "predictions"
 
-    print(f"Saved predictions to {out_path}")
+    run(frames_root, preds_root / "world_state_claude.csv")
 
 
 if __name__ == "__main__":
@@ -2,16 +2,42 @@
 
 from pathlib import Path
 import csv
-from typing import List, Dict, Any, Tuple
+from itertools import groupby
+from operator import itemgetter
+from typing import List, Dict, Any, Optional, Tuple
+
+from .temporal_smoothing import sort_by_clip
+
+
+# Read and write CSVs through 1 MB buffers.
+CSV_BUFFER_SIZE = 1 << 20
+
+
+# Columns this stage reads from the smoothed predictions.
+SMOOTHED_FIELDS = ["clip", "frame_index", "affordance_smoothed", "yield_to_smoothed", "lead_state_smoothed"]
 
 
 def load_smoothed_rows(csv_path: Path) -> List[Dict[str, Any]]:
-    with csv_path.open("r", newline="") as f:
-        reader = csv.DictReader(f)
-        rows = list(reader)
-    for r in rows:
-        r["frame_index"] = int(r["frame_index"])
-    return rows
+    """
+    Load only SMOOTHED_FIELDS (frame_index as int), parsed with csv.reader
+    and header column indices rather than a full DictReader row per line.
+    """
+    with csv_path.open("r", newline="", buffering=CSV_BUFFER_SIZE) as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        if not header:
+            return []
+        clip_i, fi_i, aff_i, yield_i, lead_i = (header.index(c) for c in SMOOTHED_FIELDS)
+        return [
+            {
+                "clip": row[clip_i],
+                "frame_index": int(row[fi_i]),
+                "affordance_smoothed": row[aff_i],
+                "yield_to_smoothed": row[yield_i],
+                "lead_state_smoothed": row[lead_i],
+            }
+            for row in reader
+        ]
 
 
 def infer_phase(seg) -> str:
@@ -92,23 +118,26 @@ def segment_clip(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     return segments
 
 
-def main():
-    project_root = Path(__file__).resolve().parents[1]
-    preds_root = project_root / "data" / "predictions"
-    csv_path = preds_root / "world_state_claude_smoothed.csv"
-
-    if not csv_path.exists():
-        raise FileNotFoundError(f"Smoothed predictions file not found: {csv_path}")
-
-    rows = load_smoothed_rows(csv_path)
+def run(
+    csv_path: Path,
+    out_path: Path,
+    rows: Optional[List[Dict[str, Any]]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Segment smoothed predictions per clip and write them to out_path.
+    Uses the given in-memory smoothed rows if provided, otherwise reads csv_path.
+    Returns the segment rows as written.
+    """
+    if rows is None:
+        if not csv_path.exists():
+            raise FileNotFoundError(f"Smoothed predictions file not found: {csv_path}")
+        rows = load_smoothed_rows(csv_path)
 
-    # group rows per clip
-    by_clip: Dict[str, List[Dict[str, Any]]] = {}
-    for r in rows:
-        by_clip.setdefault(r["clip"], []).append(r)
+    # Order by clip then frame (usually already the case); clips are then
+    # consecutive runs.
+    ordered = sort_by_clip(rows)
 
     # CSV output
-    out_path = preds_root / "world_state_segments.csv"
     fieldnames = [
         "clip",
         "segment_id",
@@ -119,13 +148,13 @@ def main():
         "lead_state",
         "phase"
     ]
-    with out_path.open("w", newline="") as fw:
+    seg_rows: List[Dict[str, Any]] = []
+    with out_path.open("w", newline="", buffering=CSV_BUFFER_SIZE) as fw:
         writer = csv.DictWriter(fw, fieldnames=fieldnames)
         writer.writeheader()
 
-        for clip, clip_rows in by_clip.items():
-            clip_rows = sorted(clip_rows, key=lambda r: r["frame_index"])
-            segments = segment_clip(clip_rows)
+        for clip, clip_rows in groupby(ordered, key=itemgetter("clip")):
+            segments = segment_clip(list(clip_rows))
 
             print(f"\n=== Clip: {clip} ===")
             for seg_id, seg in enumerate(segments):
@@ -146,7 +175,7 @@ def main():
 
                 print(f"{span}: {phase} ({a},{y},{l})")
 
-                writer.writerow({
+                seg_row = {
                     "clip": clip,
                     "segment_id": seg_id,  # resets per clip
                     "start": s,
@@ -155,9 +184,22 @@ def main():
                     "yield_to": y,
                     "lead_state": l,
                     "phase": phase,
-                })
+                }
+                seg_rows.append(seg_row)
+
+        writer.writerows(seg_rows)
 
     print(f"\nSaved segments to {out_path}")
+    return seg_rows
+
+
+def main():
+    project_root = Path(__file__).resolve().parents[1]
+    preds_root = project_root / "data" / "predictions"
+    csv_path = preds_root / "world_state_claude_smoothed.csv"
+    out_path = preds_root / "world_state_segments.csv"
+
+    run(csv_path, out_path)
 
 
 if __name__ == "__main__":
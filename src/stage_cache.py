@@ -0,0 +1,147 @@
+# src/stage_cache.py
+
+"""
+Content-hashed cache for pipeline stages.
+
+A stage's cache key is a blake2b digest over:
+  - the stage id,
+  - the bytes (and relative names) of every input file / directory,
+  - the source code of the modules implementing the stage,
+  - any stage config (window sizes, fps, ...).
+
+Outputs are stored under data/cache/<stage_id>/<key>/ and copied back into
+place on a hit. So a stage is skipped exactly when its inputs, code and
+config are unchanged, and any upstream edit re-runs everything downstream.
+Only the max_entries most recently used entries per stage are kept.
+"""
+
+import hashlib
+import inspect
+import os
+import shutil
+from pathlib import Path
+from types import ModuleType
+from typing import Any, Dict, Iterable, Optional, Sequence
+
+
+_CHUNK_SIZE = 1 << 20
+
+
+def _update_with_file(h: "hashlib.blake2b", path: Path) -> None:
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            h.update(chunk)
+
+
+def hash_path(path: Path) -> str:
+    """
+    Digest one file or directory (recursively, in sorted order) with its name.
+    A missing path hashes as absent, so creating it later changes the key.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(path.name).encode())
+    if path.is_dir():
+        for p in sorted(q for q in path.rglob("*") if q.is_file()):
+            h.update(str(p.relative_to(path)).encode())
+            _update_with_file(h, p)
+    elif path.is_file():
+        _update_with_file(h, path)
+    else:
+        h.update(b"<missing>")
+    return h.hexdigest()
+
+
+def hash_inputs(paths: Iterable[Path], known: Optional[Dict[Path, str]] = None) -> str:
+    """
+    Digest the contents of files and directories. Paths in known reuse that
+    precomputed hash_path digest instead of being read again.
+    """
+    known = known or {}
+    h = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        digest = known.get(path)
+        h.update((digest or hash_path(path)).encode())
+    return h.hexdigest()
+
+
+def hash_code(modules: Iterable[ModuleType]) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for mod in modules:
+        h.update(mod.__name__.encode())
+        h.update(inspect.getsource(mod).encode())
+    return h.hexdigest()
+
+
+def stage_key(
+    stage_id: str,
+    inputs: Iterable[Path],
+    modules: Iterable[ModuleType],
+    config: Optional[Dict[str, Any]] = None,
+    known: Optional[Dict[Path, str]] = None,
+) -> str:
+    """
+    Causal key for one stage run: (stage_id, hash(inputs), hash(code), config).
+    known holds precomputed input digests (see hash_inputs).
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(stage_id.encode())
+    h.update(hash_inputs(inputs, known).encode())
+    h.update(hash_code(modules).encode())
+    h.update(repr(sorted((config or {}).items())).encode())
+    return h.hexdigest()
+
+
+class StageCache:
+    def __init__(self, root: Path, max_entries: int = 1):
+        self.root = root
+        self.max_entries = max_entries
+
+    def _entry_dir(self, stage_id: str, key: str) -> Path:
+        return self.root / stage_id / key
+
+    def has_stage(self, stage_id: str) -> bool:
+        """True if any entry has ever been stored for this stage."""
+        d = self.root / stage_id
+        return d.is_dir() and any(d.iterdir())
+
+    def lookup(self, stage_id: str, key: str, outputs: Sequence[Path]) -> bool:
+        """
+        On a hit, make sure every output file matches the cached copy and return True.
+        """
+        entry = self._entry_dir(stage_id, key)
+        cached = [entry / out.name for out in outputs]
+        if not all(c.is_file() for c in cached):
+            return False
+
+        for c, out in zip(cached, outputs):
+            if out.is_file() and hash_path(out) == hash_path(c):
+                continue
+            out.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(c, out)
+        # Mark as recently used for prune().
+        os.utime(entry)
+        return True
+
+    def put(self, stage_id: str, key: str, outputs: Sequence[Path]) -> None:
+        """Store freshly produced outputs; missing outputs are not cached."""
+        if not all(out.is_file() for out in outputs):
+            return
+        entry = self._entry_dir(stage_id, key)
+        entry.mkdir(parents=True, exist_ok=True)
+        for out in outputs:
+            shutil.copy2(out, entry / out.name)
+        os.utime(entry)
+        self.prune(stage_id)
+
+    def prune(self, stage_id: str) -> None:
+        """Delete all but the max_entries most recently used entries of a stage."""
+        d = self.root / stage_id
+        if not d.is_dir():
+            return
+        entries = sorted(
+            (p for p in d.iterdir() if p.is_dir()),
+            key=lambda p: p.stat().st_mtime,
+            reverse=True,
+        )
+        for old in entries[self.max_entries:]:
+            shutil.rmtree(old, ignore_errors=True)
@@ -1,71 +1,138 @@
 # src/temporal_smoothing.py
 
 import csv
-from collections import Counter
+from itertools import groupby
+from operator import itemgetter
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
 
 INPUT_FILENAME = "world_state_claude.csv"
 OUTPUT_FILENAME = "world_state_claude_smoothed.csv"
 
+# Read and write CSVs through 1 MB buffers.
+CSV_BUFFER_SIZE = 1 << 20
 
-def majority_vote(values: List[str]) -> str:
-    """Return the most common non-empty value, or '' if none."""
-    non_empty = [v for v in values if v]
-    if not non_empty:
-        return ""
-    counts = Counter(non_empty)
-    return counts.most_common(1)[0][0]
+# Only these prediction columns are loaded; free-text columns in older
+# predictions files are dropped.
+PRED_FIELDS = ("clip", "frame_index", "affordance", "yield_to", "lead_state")
 
 
-def smooth_sequence(rows: List[Dict[str, Any]], window: int = 3) -> List[Dict[str, Any]]:
+def in_clip_order(rows: List[Dict[str, Any]]) -> bool:
     """
-    Apply temporal smoothing over a list of rows from a single clip,
-    assuming they are sorted by frame_index.
+    True if each clip's rows are contiguous and strictly increasing in
+    frame_index, i.e. already in the order a sort would produce. This is how
+    run_vlm_inference writes them.
     """
-    n = len(rows)
-    half = window // 2
+    seen = set()
+    prev_clip = None
+    prev_fi = None
+    for r in rows:
+        clip = r["clip"]
+        if clip != prev_clip:
+            if clip in seen:
+                return False
+            seen.add(clip)
+            prev_clip = clip
+        elif r["frame_index"] <= prev_fi:
+            return False
+        prev_fi = r["frame_index"]
+    return True
+
+
+def sort_by_clip(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Rows ordered by (clip order of first appearance, frame_index). The O(N)
+    in_clip_order check skips the sort for already-ordered input.
+    """
+    if in_clip_order(rows):
+        return rows
+    clip_rank: Dict[str, int] = {}
+    for r in rows:
+        clip_rank.setdefault(r["clip"], len(clip_rank))
+    return sorted(rows, key=lambda r: (clip_rank[r["clip"]], r["frame_index"]))
 
-    smoothed: List[Dict[str, Any]] = []
 
-    for i in range(n):
-        start = max(0, i - half)
-        end = min(n - 1, i + half)
+def smooth_labels(values: List[str], window: int = 3) -> List[str]:
+    """
+    Majority vote of the non-empty labels in a centred window (truncated at
+    the clip edges), for every frame at once. Ties go to the label seen first
+    in the window; frames whose window has no label keep their own value.
 
-        window_rows = rows[start : end + 1]
+    Labels are encoded to small ints and each window is counted with numpy
+    over a sliding_window_view, one pass per distinct label.
+    """
+    n = len(values)
+    vocab = list(dict.fromkeys(v for v in values if v))
+    if not vocab:
+        return list(values)
 
-        aff_vals = [r["affordance"] for r in window_rows]
-        y_vals = [r["yield_to"] for r in window_rows]
-        lead_vals = [r["lead_state"] for r in window_rows]
+    code = {v: i for i, v in enumerate(vocab)}
+    codes = np.fromiter((code.get(v, -1) for v in values), dtype=np.int32, count=n)
 
-        aff_s = majority_vote(aff_vals)
-        y_s = majority_vote(y_vals)
-        lead_s = majority_vote(lead_vals)
+    # -1 marks empty labels and the padding past either edge; it never votes.
+    half = window // 2
+    windows = sliding_window_view(np.pad(codes, half, constant_values=-1), 2 * half + 1)
+    width = windows.shape[1]
 
-        row = dict(rows[i])  # copy original row
-        row["affordance_smoothed"] = aff_s or row["affordance"]
-        row["yield_to_smoothed"] = y_s or row["yield_to"]
-        row["lead_state_smoothed"] = lead_s or row["lead_state"]
-        smoothed.append(row)
+    # Score = count, then earliest first occurrence: count * (width + 1) - first.
+    best = np.full(n, -1, dtype=np.int32)
+    best_score = np.full(n, -1, dtype=np.int64)
+    for c in range(len(vocab)):
+        hits = windows == c
+        count = hits.sum(axis=1)
+        score = count * (width + 1) - hits.argmax(axis=1)
+        take = (count > 0) & (score > best_score)
+        best[take] = c
+        best_score[take] = score[take]
 
-    return smoothed
+    return [vocab[b] if b >= 0 else v for b, v in zip(best.tolist(), values)]
 
 
-def main():
-    project_root = Path(__file__).resolve().parents[1]
-    preds_root = project_root / "data" / "predictions"
+def smooth_sequence(rows: List[Dict[str, Any]], window: int = 3) -> List[Dict[str, Any]]:
+    """
+    Apply temporal smoothing over a list of rows from a single clip,
+    assuming they are sorted by frame_index.
+    """
+    aff_s = smooth_labels([r["affordance"] for r in rows], window)
+    y_s = smooth_labels([r["yield_to"] for r in rows], window)
+    lead_s = smooth_labels([r["lead_state"] for r in rows], window)
 
-    in_path = preds_root / INPUT_FILENAME
-    out_path = preds_root / OUTPUT_FILENAME
+    smoothed: List[Dict[str, Any]] = []
+    for r, a, y, l in zip(rows, aff_s, y_s, lead_s):
+        row = dict(r)  # copy original row
+        row["affordance_smoothed"] = a
+        row["yield_to_smoothed"] = y
+        row["lead_state_smoothed"] = l
+        smoothed.append(row)
 
-    if not in_path.exists():
-        raise FileNotFoundError(f"Input predictions file not found: {in_path}")
+    return smoothed
+
+
+def run(
+    in_path: Path,
+    out_path: Path,
+    rows: Optional[List[Dict[str, Any]]] = None,
+    window: int = 3,
+) -> List[Dict[str, Any]]:
+    """
+    Smooth raw predictions and write them to out_path.
+    Uses the given in-memory rows if provided, otherwise reads in_path.
+    Returns the smoothed rows.
+    """
+    if rows is None:
+        if not in_path.exists():
+            raise FileNotFoundError(f"Input predictions file not found: {in_path}")
 
-    # Read all rows
-    with in_path.open("r", newline="") as f:
-        reader = csv.DictReader(f)
-        rows = list(reader)
+        # Read the prediction columns of every row
+        with in_path.open("r", newline="", buffering=CSV_BUFFER_SIZE) as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            cols = [(name, header.index(name)) for name in PRED_FIELDS if name in header]
+            rows = [{name: row[i] for name, i in cols} for row in reader]
 
     if not rows:
         raise RuntimeError("No rows in input predictions file.")
@@ -74,17 +141,13 @@ def main():
     for r in rows:
         r["frame_index"] = int(r["frame_index"])
 
-    # Group by clip
-    by_clip: Dict[str, List[Dict[str, Any]]] = {}
-    for r in rows:
-        clip = r["clip"]
-        by_clip.setdefault(clip, []).append(r)
+    # Order rows by clip then frame (usually already the case), then smooth
+    # each clip's run of rows.
+    ordered = sort_by_clip(rows)
 
-    # Sort each clip by frame_index and smooth
     all_smoothed: List[Dict[str, Any]] = []
-    for clip, clip_rows in by_clip.items():
-        clip_rows_sorted = sorted(clip_rows, key=lambda r: r["frame_index"])
-        smoothed_rows = smooth_sequence(clip_rows_sorted, window=3)
+    for clip, clip_rows in groupby(ordered, key=itemgetter("clip")):
+        smoothed_rows = smooth_sequence(list(clip_rows), window=window)
         all_smoothed.extend(smoothed_rows)
 
     # Preserve original fieldnames and add smoothed columns
@@ -92,13 +155,23 @@ def main():
     extra_fields = ["affordance_smoothed", "yield_to_smoothed", "lead_state_smoothed"]
     fieldnames = base_fields + extra_fields
 
-    with out_path.open("w", newline="") as f:
+    with out_path.open("w", newline="", buffering=CSV_BUFFER_SIZE) as f:
         writer = csv.DictWriter(f, fieldnames=fieldnames)
         writer.writeheader()
-        for r in all_smoothed:
-            writer.writerow(r)
+        writer.writerows(all_smoothed)
 
     print(f"Saved smoothed predictions to {out_path}")
+    return all_smoothed
+
+
+def main():
+    project_root = Path(__file__).resolve().parents[1]
+    preds_root = project_root / "data" / "predictions"
+
+    in_path = preds_root / INPUT_FILENAME
+    out_path = preds_root / OUTPUT_FILENAME
+
+    run(in_path, out_path, window=3)
 
 
 if __name__ == "__main__":
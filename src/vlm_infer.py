@@ -1,12 +1,27 @@
 # src/vlm_infer.py
 
 import os
-import base64
+import asyncio
+import hashlib
+import io
+import json
+import mmap
+import random
+import re
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
-from anthropic import Anthropic
+from anthropic import Anthropic, AsyncAnthropic, APIConnectionError, APIStatusError
+from PIL import Image
+
+# pybase64 (SIMD) is a drop-in for the stdlib encoder when installed.
+try:
+    from pybase64 import b64encode
+except ImportError:
+    from base64 import b64encode
 
 
 SYSTEM_PROMPT = """
@@ -72,30 +87,160 @@ Now analyze the provided frame and respond in the same format.
 """.strip()
 
 
+BATCH_PROMPT = """
+You are given {n} frames from forward-facing driving videos, each preceded by its label frame_1 ... frame_{n}.
+Analyze every frame independently and infer the current world state for the ego vehicle in each one.
+
+Return exactly {n} answers, one per frame, in order. Each answer starts with the frame's label and uses this exact format:
+
+frame_<i>: affordance=<go|wait|stop>; yield_to=<none|lead|ped>; lead_state=<none|moving|stopped>;
+explanation: <one short sentence explaining why.>
+
+Example for two frames:
+
+frame_1: affordance=stop; yield_to=lead; lead_state=stopped;
+explanation: The ego car is stopped behind another vehicle at a red light, waiting for the signal to change.
+frame_2: affordance=go; yield_to=lead; lead_state=moving;
+explanation: The ego car is moving along the highway following a vehicle ahead that is also moving.
+""".strip()
+
+
+# Bump whenever the prompts or the parsed output schema change, so cached
+# results from the old prompt are not reused.
+PROMPT_VERSION = "v2"
+
+# Frames are downscaled to fit MAX_IMAGE_SIDE and re-encoded as JPEG before
+# upload; the model downsamples large images anyway.
+MAX_IMAGE_SIDE = 1024
+JPEG_QUALITY = 85
+
+# Per-image answer budget; a batched request gets this times its frame count.
+MAX_TOKENS_PER_FRAME = 256
+
+# Parsed results, one JSON file per (frame bytes, model, PROMPT_VERSION,
+# upload size/quality, single-frame vs batched request).
+RESULT_CACHE_DIR = Path.home() / ".cache" / "vlm_world_model"
+
+# Retry policy for transient API errors (429 rate limits, 5xx/overloaded,
+# connection drops): exponential backoff with jitter, capped at BACKOFF_MAX.
+# This is the only retry layer; the SDK clients are built with max_retries=0.
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+
+
+def _is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, APIConnectionError):
+        return True
+    if isinstance(exc, APIStatusError):
+        return exc.status_code == 429 or exc.status_code >= 500
+    return False
+
+
+def _backoff_delay(attempt: int) -> float:
+    """Seconds to wait before retry number attempt (0-based)."""
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _retry_delay(exc: Exception, attempt: int, what: str) -> float:
+    """Backoff before retrying a failed call, or re-raise exc when it should not be retried."""
+    if attempt == MAX_RETRIES or not _is_retryable(exc):
+        raise exc
+    delay = _backoff_delay(attempt)
+    print(f"[VLMWorldModel] {type(exc).__name__} for {what}, retrying in {delay:.1f}s")
+    return delay
+
+
+# Frame reads + base64 encodes for async callers run here, so they overlap
+# with in-flight requests instead of blocking the event loop.
+_ENCODE_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="vlm-encode")
+
+
+def _advise_sequential(f: Any) -> int:
+    """Hint a front-to-back scan of f where supported; returns its size."""
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    return os.fstat(f.fileno()).st_size
+
+
 def _load_image_base64(path: Path) -> str:
     with path.open("rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
+        if _advise_sequential(f) == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return b64encode(mm).decode("ascii")
 
 
-def parse_world_state(text: str) -> Dict[str, str]:
+def _frame_digest(path: Path) -> str:
+    """SHA1 of the frame bytes, hashed straight from a read-only mmap."""
+    with path.open("rb") as f:
+        if _advise_sequential(f) == 0:
+            return hashlib.sha1(b"").hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.sha1(mm).hexdigest()
+
+
+def _encode_frame(path: Path) -> Tuple[str, str]:
     """
-    Parse the model's response into a structured dict.
+    Return (base64 data, media_type) for a frame image.
+    JPEGs that already fit MAX_IMAGE_SIDE are sent untouched; anything else
+    is downscaled and re-encoded as JPEG (JPEG_QUALITY) in memory.
+    """
+    with Image.open(path) as im:
+        if im.format == "JPEG" and max(im.size) <= MAX_IMAGE_SIDE:
+            return _load_image_base64(path), "image/jpeg"
 
-    Expected format:
-    affordance=wait; yield_to=ped; lead_state=stopped;
-    explanation: The ego vehicle is ...
+        # JPEG draft mode decodes at a reduced DCT scale (still >= the target).
+        im.draft("RGB", (MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+        im = im.convert("RGB")
+        im.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.LANCZOS)
+        buf = io.BytesIO()
+        im.save(buf, format="JPEG", quality=JPEG_QUALITY)
+
+    return b64encode(buf.getbuffer()).decode("ascii"), "image/jpeg"
+
+
+VALID_AFFORDANCES = frozenset({"go", "wait", "stop"})
+VALID_YIELD_TO = frozenset({"none", "lead", "ped"})
+VALID_LEAD_STATES = frozenset({"none", "moving", "stopped"})
+
+# The canonical two-line answer:
+#   affordance=<a>; yield_to=<y>; lead_state=<l>;
+#   explanation: <text>
+# (blank lines between them are allowed). Anything else goes through the
+# line-by-line parser.
+_RESP_RE = re.compile(
+    r"\s*affordance\s*=\s*(\w*)\s*;"
+    r"\s*yield_to\s*=\s*(\w*)\s*;"
+    r"\s*lead_state\s*=\s*(\w*)[^\S\n]*;?[^\S\n]*\n"
+    r"\s*(?i:explanation):([^\n]*)"
+)
+
+
+# "frame_<i>:" labels at line starts in a batched answer.
+_FRAME_MARKER_RE = re.compile(r"^[^\S\n]*frame_(\d+)[^\S\n]*:", re.MULTILINE | re.IGNORECASE)
+
+
+def split_batch_answer(text: str, n: int) -> List[Optional[str]]:
     """
-    out: Dict[str, str] = {
-        "affordance": "",
-        "yield_to": "",
-        "lead_state": "",
-        "explanation": "",
-        "raw": text.strip(),
-    }
+    Split a batched answer on its frame_<i>: labels into n per-frame answers
+    (in the single-frame format). Frames the model skipped come back as None.
+    """
+    answers: List[Optional[str]] = [None] * n
+    markers = list(_FRAME_MARKER_RE.finditer(text))
+    for m, nxt in zip(markers, markers[1:] + [None]):
+        i = int(m.group(1)) - 1
+        if 0 <= i < n and answers[i] is None:
+            answers[i] = text[m.end():nxt.start() if nxt else len(text)]
+    return answers
 
+
+def _parse_world_state_lines(text: str, out: Dict[str, str]) -> None:
+    """Fallback parser for answers that do not match _RESP_RE; fills out in place."""
     lines = [ln.strip() for ln in text.strip().splitlines() if ln.strip()]
     if not lines:
-        return out
+        return
 
     first = lines[0]
     if len(lines) > 1 and lines[1].lower().startswith("explanation:"):
@@ -109,16 +254,36 @@ def parse_world_state(text: str) -> Dict[str, str]:
             k, v = part.split("=", 1)
             out[k.strip()] = v.strip()
 
-    # clamp to valid vocab
-    valid_aff = {"go", "wait", "stop"}
-    valid_yield = {"none", "lead", "ped"}
-    valid_lead = {"none", "moving", "stopped"}
 
-    if out["affordance"] not in valid_aff:
+def parse_world_state(text: str) -> Dict[str, str]:
+    """
+    Parse the model's response into a structured dict.
+
+    Expected format:
+    affordance=wait; yield_to=ped; lead_state=stopped;
+    explanation: The ego vehicle is ...
+    """
+    out: Dict[str, str] = {
+        "affordance": "",
+        "yield_to": "",
+        "lead_state": "",
+        "explanation": "",
+        "raw": text.strip(),
+    }
+
+    m = _RESP_RE.match(text)
+    if m:
+        out["affordance"], out["yield_to"], out["lead_state"] = m.group(1, 2, 3)
+        out["explanation"] = m.group(4).strip()
+    else:
+        _parse_world_state_lines(text, out)
+
+    # clamp to valid vocab
+    if out["affordance"] not in VALID_AFFORDANCES:
         out["affordance"] = ""
-    if out["yield_to"] not in valid_yield:
+    if out["yield_to"] not in VALID_YIELD_TO:
         out["yield_to"] = ""
-    if out["lead_state"] not in valid_lead:
+    if out["lead_state"] not in VALID_LEAD_STATES:
         out["lead_state"] = ""
 
     return out
@@ -129,34 +294,59 @@ class VLMWorldModel:
         self,
         api_key: Optional[str] = None,
         model_name: str = "claude-haiku-4-5-20251001",
+        cache_dir: Optional[Path] = RESULT_CACHE_DIR,
     ):
+        """cache_dir=None disables the on-disk result cache."""
         api_key = api_key or os.environ.get("ANTHROPIC_API_KEY")
         if not api_key:
             raise ValueError("ANTHROPIC_API_KEY is not set in the environment.")
-        self.client = Anthropic(api_key=api_key)
+        # SDK retries are off: _create/_acreate apply the MAX_RETRIES policy.
+        self.client = Anthropic(api_key=api_key, max_retries=0)
+        self.async_client = AsyncAnthropic(api_key=api_key, max_retries=0)
         self.model_name = model_name
-
-    def infer_frame(self, image_path: Path) -> Dict[str, str]:
-        print(f"[VLMWorldModel] Calling Claude for: {image_path}")  # debug log
-
-        # Encode image
-        image_b64 = _load_image_base64(image_path)
-
-        # Pick media_type based on extension
-        suffix = image_path.suffix.lower()
-        if suffix in [".png"]:
-            media_type = "image/png"
-        else:
-            # default to jpeg
-            media_type = "image/jpeg"
-
-        start = time.time()
-        msg = self.client.messages.create(
-            model=self.model_name,
-            max_tokens=256,
-            temperature=0.1,
-            system=SYSTEM_PROMPT,
-            messages=[
+        self.cache_dir = cache_dir
+
+    def _cache_path(self, digest: str, batched: bool = False) -> Optional[Path]:
+        """Answers from batched requests use another prompt, so they get their own key."""
+        if self.cache_dir is None:
+            return None
+        key = f"{digest}:{self.model_name}:{PROMPT_VERSION}:{MAX_IMAGE_SIDE}:{JPEG_QUALITY}"
+        if batched:
+            key += ":batch"
+        key = hashlib.sha1(key.encode()).hexdigest()
+        return self.cache_dir / f"{key}.json"
+
+    @staticmethod
+    def _load_cached(cache_path: Optional[Path]) -> Optional[Dict[str, str]]:
+        if cache_path is None or not cache_path.is_file():
+            return None
+        try:
+            with cache_path.open("r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _store_cached(cache_path: Optional[Path], result: Dict[str, str]) -> None:
+        """Write via a temp file + rename so readers never see a partial entry."""
+        if cache_path is None:
+            return
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=cache_path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(result, f)
+            os.replace(tmp, cache_path)
+        except OSError:
+            Path(tmp).unlink(missing_ok=True)
+
+    def _build_request(self, image_b64: str, media_type: str) -> Dict[str, Any]:
+        return {
+            "model": self.model_name,
+            "max_tokens": MAX_TOKENS_PER_FRAME,
+            "temperature": 0.1,
+            "system": SYSTEM_PROMPT,
+            "messages": [
                 {
                     "role": "user",
                     "content": [
@@ -172,21 +362,165 @@ class VLMWorldModel:
                     ],
                 },
             ],
-        )
-        elapsed = time.time() - start
-        print(f"[VLMWorldModel] Claude call completed in {elapsed:.2f}s for: {image_path.name}")
-
-        # Add delay to avoid rate limiting (0.5 seconds between API calls)
-        time.sleep(0.5)
-
+        }
+
+    def _build_batch_request(self, encoded: List[Tuple[str, str]]) -> Dict[str, Any]:
+        """One request carrying several frames, each image preceded by its frame_<i> label."""
+        content: List[Dict[str, Any]] = [
+            {"type": "text", "text": BATCH_PROMPT.format(n=len(encoded))},
+        ]
+        for i, (image_b64, media_type) in enumerate(encoded, start=1):
+            content.append({"type": "text", "text": f"frame_{i}:"})
+            content.append(
+                {
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": media_type,
+                        "data": image_b64,
+                    },
+                }
+            )
+
+        return {
+            "model": self.model_name,
+            "max_tokens": MAX_TOKENS_PER_FRAME * len(encoded),
+            "temperature": 0.1,
+            "system": SYSTEM_PROMPT,
+            "messages": [{"role": "user", "content": content}],
+        }
+
+    @staticmethod
+    def _message_text(msg: Any) -> str:
         # Collect text blocks
         text_chunks = []
         for block in msg.content:
             if getattr(block, "type", None) == "text":
                 text_chunks.append(block.text)
-        full_text = "\n".join(text_chunks).strip()
+        return "\n".join(text_chunks).strip()
 
+    @classmethod
+    def _parse_message(cls, msg: Any) -> Dict[str, str]:
+        full_text = cls._message_text(msg)
         parsed = parse_world_state(full_text)
         if not parsed.get("raw"):
             parsed["raw"] = full_text
         return parsed
+
+    def _create(self, request: Dict[str, Any], what: str) -> Any:
+        start = time.time()
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                msg = self.client.messages.create(**request)
+                break
+            except Exception as e:
+                time.sleep(_retry_delay(e, attempt, what))
+        elapsed = time.time() - start
+        print(f"[VLMWorldModel] Claude call completed in {elapsed:.2f}s for: {what}")
+        return msg
+
+    async def _acreate(self, request: Dict[str, Any], what: str) -> Any:
+        start = time.time()
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                msg = await self.async_client.messages.create(**request)
+                break
+            except Exception as e:
+                await asyncio.sleep(_retry_delay(e, attempt, what))
+        elapsed = time.time() - start
+        print(f"[VLMWorldModel] Claude call completed in {elapsed:.2f}s for: {what}")
+        return msg
+
+    def infer_frame(self, image_path: Path) -> Dict[str, str]:
+        cache_path = self._cache_path(_frame_digest(image_path))
+        cached = self._load_cached(cache_path)
+        if cached is not None:
+            return cached
+
+        print(f"[VLMWorldModel] Calling Claude for: {image_path}")  # debug log
+
+        # Encode image
+        request = self._build_request(*_encode_frame(image_path))
+        msg = self._create(request, image_path.name)
+
+        # Add delay to avoid rate limiting (0.5 seconds between API calls)
+        time.sleep(0.5)
+
+        result = self._parse_message(msg)
+        self._store_cached(cache_path, result)
+        return result
+
+    async def ainfer_frame(self, image_path: Path) -> Dict[str, str]:
+        """
+        Async variant of infer_frame for batched callers. No fixed sleep:
+        callers bound the number of in-flight requests instead.
+        """
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(_ENCODE_EXECUTOR, _frame_digest, image_path)
+        cache_path = self._cache_path(digest)
+        cached = self._load_cached(cache_path)
+        if cached is not None:
+            return cached
+
+        print(f"[VLMWorldModel] Calling Claude for: {image_path}")  # debug log
+
+        # Encode image off the event loop
+        encoded = await loop.run_in_executor(_ENCODE_EXECUTOR, _encode_frame, image_path)
+        request = self._build_request(*encoded)
+        msg = await self._acreate(request, image_path.name)
+
+        result = self._parse_message(msg)
+        self._store_cached(cache_path, result)
+        return result
+
+    def _store_batch(
+        self,
+        msg: Any,
+        paths: List[Path],
+        cache_paths: List[Optional[Path]],
+    ) -> List[Optional[Dict[str, str]]]:
+        """Parse a batched answer and cache each frame's result; skipped frames stay None."""
+        answers = split_batch_answer(self._message_text(msg), len(paths))
+        results: List[Optional[Dict[str, str]]] = []
+        for answer, cache_path in zip(answers, cache_paths):
+            if answer is None:
+                results.append(None)
+                continue
+            result = parse_world_state(answer)
+            self._store_cached(cache_path, result)
+            results.append(result)
+        return results
+
+    async def ainfer_frames(self, image_paths: List[Path]) -> List[Dict[str, str]]:
+        """
+        Infer several frames with a single request. Cached frames are not
+        resent; a lone uncached frame, or one missing from the batched answer,
+        goes through ainfer_frame instead.
+        """
+        loop = asyncio.get_running_loop()
+        digests = await asyncio.gather(
+            *(loop.run_in_executor(_ENCODE_EXECUTOR, _frame_digest, p) for p in image_paths)
+        )
+        cache_paths = [self._cache_path(d, batched=True) for d in digests]
+        results = [self._load_cached(c) for c in cache_paths]
+        todo = [i for i, r in enumerate(results) if r is None]
+        if len(todo) == 1:
+            results[todo[0]] = await self.ainfer_frame(image_paths[todo[0]])
+            todo = []
+
+        if todo:
+            paths = [image_paths[i] for i in todo]
+            what = f"{len(paths)} frames ({paths[0].name}..{paths[-1].name})"
+            print(f"[VLMWorldModel] Calling Claude for: {what}")  # debug log
+
+            encoded = await asyncio.gather(
+                *(loop.run_in_executor(_ENCODE_EXECUTOR, _encode_frame, p) for p in paths)
+            )
+            request = self._build_batch_request(list(encoded))
+            msg = await self._acreate(request, what)
+
+            batch = self._store_batch(msg, paths, [cache_paths[i] for i in todo])
+            for i, result in zip(todo, batch):
+                results[i] = result if result is not None else await self.ainfer_frame(image_paths[i])
+
+        return results